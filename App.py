@@ -5,6 +5,7 @@ import logging
 from os import environ as env, makedirs, path, getcwd
 
 # External
+import click
 from flask import Flask
 from werkzeug.serving import is_running_from_reloader
 from flask_login import current_user
@@ -21,6 +22,12 @@ from tasks import discord_tasks, backup_task
 from db import User
 from crypto import generate_signing_keys
 import db
+import migrations
+import imports
+import caching
+import db_snapshot
+import wordcount
+from snapshot_store import snapshot_store
 from constants import APP_VERSION
 
 # Blueprints
@@ -38,7 +45,7 @@ from blueprints.autobackup import AutobackupController
 from blueprints.embed import EmbedController
 from blueprints.leaderboard import LeaderboardController
 
-from extensions import login_manager, sched, oauth, rss, webhook, portainer
+from extensions import login_manager, sched, oauth, rss, webhook, portainer, snapshot_queue
 
 app = Flask(__name__)
 
@@ -129,6 +136,11 @@ def extensions_init() -> None:
     if app.config.get('BACKUP', {}).get('BACKUP_INTERVAL') is not None:
         sched.add_job('autobackup_run', lambda: backup_task.run_backup_task(app.config['BACKUP']['BACKUP_INTERVAL'], app), trigger='interval', hours=12)
 
+    # Periodic consistent copies of the database
+    snapshot_conf = db_snapshot.snapshot_config(app.config)
+    if snapshot_conf['ENABLE']:
+        sched.add_job('Database snapshot', lambda: db_snapshot.create_snapshot(app.config), trigger='interval', hours=snapshot_conf['INTERVAL'])
+
     # Checking if we have a webhook URL
     if config_has_key(app.config, 'WEBHOOK.WEBHOOK_URL') and config_has_key(app.config, 'DISCORD_ROLEMASTER_ID'):
         webhook.init_app(app)
@@ -136,8 +148,16 @@ def extensions_init() -> None:
     else:
         app.config['WEBHOOK_ENABLE'] = False
 
+    # Response cache, invalidated by database writes
+    caching.init_app(app)
+
     rss.init_app(app)
 
+    # Snapshots of original pages found in the RSS feeds are downloaded by background workers
+    # Started only where the scheduler runs, same as the RSS check that queues them
+    if config_has_key(app.config, "BACKUP.save_snapshots", True) and (is_running_from_reloader() or not app.config['DEBUG']):
+        snapshot_queue.init_app(app)
+
     # Checking if we have any RSS feeds configured
     if rss.has_links:
         sched.add_job('Fetch RSS updates', rss.check, trigger='interval', hours=1)
@@ -185,6 +205,101 @@ def register_blueprints(app: Flask) -> None:
     app.register_blueprint(AutobackupController)
     app.register_blueprint(EmbedController)
 
+def init_database() -> None:
+    """
+    Creates missing tables, applies pending migrations and recreates views and triggers
+    """
+    db.database.create_tables(db.models)
+    # The views refer to Article, which a migration might have to rebuild
+    db.drop_views(db.database)
+    migrations.run_migrations(db.database)
+    db.create_views(db.database)
+    db.create_triggers(db.database)
+
+def cli_init() -> None:
+    """
+    Loads the config (if there is one) and prepares the database for CLI commands
+    """
+    app.config.from_file('config.json', json.load, silent=True)
+    db.init_app(app)
+    init_database()
+
+@app.cli.command('rebuild-leaderboard')
+def rebuild_leaderboard_command():
+    """
+    Recomputes the leaderboard table from all articles
+    """
+    cli_init()
+    print(f"Leaderboard rebuilt ({db.rebuild_leaderboard()} users)")
+
+@app.cli.command('check-query-plans')
+def check_query_plans_command():
+    """
+    Fails if any of the main queries has to scan a whole table
+    """
+    cli_init()
+    scans = migrations.find_table_scans(db.database)
+    for name, steps in scans.items():
+        print(f"FULL SCAN: {name} ({'; '.join(steps)})")
+    if scans:
+        exit(1)
+    print(f"All {len(migrations.main_queries())} queries use indexes")
+
+@app.cli.command('import')
+@click.argument('kind', type=click.Choice(list(imports.IMPORTERS)))
+@click.argument('file', type=click.File('r', encoding='utf-8-sig'))
+@click.option('--format', 'import_format', type=click.Choice(list(imports.ImportFormat)), help="Defaults to the file extension")
+@click.option('--dry-run', is_flag=True, help="Only validate the records")
+def import_command(kind, file, import_format, dry_run):
+    """
+    Imports articles or users from a CSV or JSON file
+    """
+    cli_init()
+    import_format = import_format or ('json' if file.name.endswith('.json') else 'csv')
+    try:
+        records = imports.parse_records(file.read(), imports.ImportFormat(import_format))
+    except ValueError as e:
+        print(f"Invalid data ({str(e)})")
+        exit(1)
+    result = imports.IMPORTERS[kind](records, dry_run=dry_run)
+    for number, reason in result.skipped:
+        print(f"Skipped record {number}: {reason}")
+    # There's no webhook outside of the app, the promotions are only listed
+    for user, role in result.promotions:
+        print(f"{user.nickname} reaches {role['name']}")
+    print(f"{'Would import' if dry_run else 'Imported'} {result.inserted} {kind}, skipped {len(result.skipped)}")
+
+@app.cli.command('import-snapshots')
+@click.option('--delete', is_flag=True, help="Delete the text files once they're in the store")
+def import_snapshots_command(delete):
+    """
+    Copies page snapshots saved as plain text files into the snapshot store
+    """
+    cli_init()
+    print(f"Imported {snapshot_store.import_legacy(delete=delete)} snapshots")
+
+@app.cli.command('count-words')
+@click.option('--fetch', is_flag=True, help="Download sources that aren't in the snapshot store first")
+@click.option('--update', is_flag=True, help="Save the counted word counts of articles that are off")
+@click.option('--tolerance', type=float, default=wordcount.DEFAULT_TOLERANCE, show_default=True, help="Relative difference that is still fine")
+@click.option('--workers', type=int, help="Processes used for counting, defaults to the number of CPUs")
+def count_words_command(fetch, update, tolerance, workers):
+    """
+    Counts the words of all articles from their sources and lists (or fixes) the ones that don't match
+    """
+    cli_init()
+    result = wordcount.count_articles(workers=workers, fetch=fetch)
+    for name, reason in result.skipped:
+        print(f"Skipped {name}: {reason}")
+    mismatched = result.mismatched(tolerance)
+    for count in mismatched:
+        print(f"{count.name}: {count.stored} stored, {count.counted} counted ({count.link})")
+    if update and mismatched:
+        # There's no webhook outside of the app, the role changes are only listed
+        for user, role in wordcount.update_word_counts(mismatched):
+            print(f"{user.nickname} moves to {role['name']}")
+    print(f"Counted {len(result.counted)} articles, {len(mismatched)} {'updated' if update else 'off by more than ' + format(tolerance, '.0%')}, skipped {len(result.skipped)}")
+
 # TODO: App factory??
 if __name__ == '__main__':
     init_logger()
@@ -208,6 +323,7 @@ if __name__ == '__main__':
     app.config['oauth'] = oauth
     app.config['rss'] = rss
     app.config['webhook'] = webhook
+    app.config['snapshot_queue'] = snapshot_queue
 
     # Add useful template globals
     app.add_template_global(current_user, 'current_user')
@@ -219,13 +335,23 @@ if __name__ == '__main__':
     register_blueprints(app)
 
     # Initialize the database
+    db.init_app(app)
     db.database.connect()
-    db.database.create_tables(db.models)
-    db.create_views(db.database)
+    init_database()
+
+    # The leaderboard table is only maintained incrementally, fill it in if it's new or out of sync
+    if db.Leaderboard.select().count() != User.select().count():
+        info(f"Rebuilt leaderboard ({db.rebuild_leaderboard()} users)")
+
+    # Only logs a warning, a missing index makes things slow but doesn't break anything
+    migrations.check_query_plans(db.database)
 
     # Create the admin user
     user_init()
 
+    # Requests get their own connections, give this one back to the pool
+    db.database.close()
+
     # Generate signing keys
     if not generate_signing_keys():
         critical("Error while generating signing keys. Exiting...")
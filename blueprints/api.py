@@ -1,14 +1,24 @@
 from logging import warning, info, error
-from flask import jsonify, request, Blueprint, flash, redirect, url_for, abort
+from flask import jsonify, request, Blueprint, flash, redirect, url_for, abort, current_app
 from flask_login import current_user, login_required
 from datetime import datetime
+from peewee import fn, IntegrityError
 
-from db import Article, User, Frontpage, Correction
-from framework.roles import role_badge
+from db import Article, User, PAGE_ITEMS, SEARCH_LIMIT, keyset_page, split_page, search_articles, search_users, get_user_stats
+from utils import encode_cursor, decode_cursor
+from framework.roles import role_badges
+from serialization import ARTICLE, CORRECTION, ARTICLE_SEARCH, USER_SEARCH
+from imports import IMPORTERS, ImportFormat, parse_records, notify_promotions
+from caching import cached_view
 
 ApiController = Blueprint('ApiController', __name__)
 
-PAGE_ITEMS = 15
+# Leaderboard columns holding the article count for each type
+TOTAL_COLUMNS = {
+    'translation': 'translation_count',
+    'correction': 'correction_count',
+    'original': 'original_count'
+}
 
 def result_ok(result = [], extra_data = {}):
     return jsonify({
@@ -24,80 +34,66 @@ def result_error(error_message = "", status_code = 400):
             'errorMessage': error_message
         }), status_code
 
-def search_article(query):
-    title_param = f'%{query}%'
-    link_param = f"%.wikidot.com/%{query}%"
-    results = Article.select().where(Article.name ** title_param | Article.link ** link_param).prefetch(User)
-    return [{
-        'id': a.id,
-        'name': a.name,
-        'link': a.link,
-        'words': a.words,
-        'added': a.added,
-        'author': {
-            'id': a.author.id,
-            'name': a.author.display_name or a.author.nickname
-        },
-        'corrector': {
-            'id': a.corrector.id if a.corrector else 0,
-            'name': (a.corrector.display_name or a.corrector.nickname) if a.corrector else 'N/A'
-        }
-    } for a in results]
+def search_limit() -> int:
+    # SQLite treats a negative LIMIT as no limit at all
+    return max(1, min(request.args.get('l', SEARCH_LIMIT, int), SEARCH_LIMIT))
+
+# Fields of the article search results, the per-user search never included the author
+ANY_ARTICLE_FIELDS = ('id', 'name', 'link', 'words', 'added', 'author', 'corrector')
+USER_ARTICLE_FIELDS = ('id', 'name', 'link', 'words', 'bonus', 'added', 'corrector')
 
 @ApiController.route('/api/search/article_any')
+@cached_view(anonymous_only=False)
 def search_any_article():
     query = request.args.get('q', None, str)
+    limit = search_limit()
+    fields = ARTICLE_SEARCH.parse_fields(request.args.get('fields', None, str), ANY_ARTICLE_FIELDS)
     if not query:
         return result_error("No query specified", 400)
-    
-    results = search_article(query)
-    return result_ok(results)
+    if not fields:
+        return result_error("Invalid fields")
+
+    results = ARTICLE_SEARCH.apply(search_articles(query, limit=limit), fields)
+    return result_ok(ARTICLE_SEARCH.serialize(results, fields))
 
 @ApiController.route('/api/search/article')
+@cached_view(anonymous_only=False)
 def search_user_article():
     query = request.args.get('q', None, str)
     author = request.args.get('u', None, int)
+    limit = search_limit()
     if not query or not author:
         return result_error("Parameters missing")
-    
+
     if author == -1:
-        return result_ok(search_article(query))
+        fields = ARTICLE_SEARCH.parse_fields(request.args.get('fields', None, str), ANY_ARTICLE_FIELDS)
+        results = search_articles(query, limit=limit)
     else:
-        title_param = f'%{query}%'
-        link_param = f"%.wikidot.com/%{query}%"
-        results = Article.select().where((Article.name ** title_param | Article.link ** link_param) & (Article.author == author)).prefetch(User)
-        return result_ok([{
-                'id': a.id,
-                'name': a.name,
-                'link': a.link,
-                'words': a.words,
-                'bonus': a.bonus,
-                'added': a.added,
-                'corrector': {
-                    'id': a.corrector.id if a.corrector else 0,
-                    'name': (a.corrector.display_name or a.corrector.nickname) if a.corrector else 'N/A'
-                }
-            } for a in results])
+        fields = ARTICLE_SEARCH.parse_fields(request.args.get('fields', None, str), USER_ARTICLE_FIELDS)
+        results = search_articles(query, author, limit)
+    if not fields:
+        return result_error("Invalid fields")
+    return result_ok(ARTICLE_SEARCH.serialize(ARTICLE_SEARCH.apply(results, fields), fields))
 
 @ApiController.route('/api/search/user')
+@cached_view(anonymous_only=False)
 def search_user():
     query = request.args.get('q', None, str)
+    limit = search_limit()
+    fields = USER_SEARCH.parse_fields(request.args.get('fields', None, str))
     if not query:
         return result_error("No query specified")
-    param = f'%{query}%'
-    user = Frontpage.select().join(User).where(Frontpage.user.nickname ** param |
-                                                Frontpage.user.wikidot ** param |
-                                                Frontpage.user.display_name ** param |
-                                                Frontpage.user.discord ** param)
-    results = [{'id': u.user.id,
-            'nickname': u.user.nickname,
-            'discord': u.user.discord,
-            'wikidot': u.user.wikidot,
-            'displayname': u.user.display_name,
-            'tr_count': u.translation_count,
-            'cr_count': u.correction_count,
-            'tr_role_html': role_badge(u.points),
-            'points': u.points} for u in user]
+    if not fields:
+        return result_error("Invalid fields")
+    # Badges are computed from the points
+    with_badges = 'tr_role_html' in fields
+    results = USER_SEARCH.serialize(USER_SEARCH.apply(search_users(query, limit), fields + ('points',)), fields + ('points',))
+    if with_badges:
+        for result, badge in zip(results, role_badges([r['points'] for r in results])):
+            result['tr_role_html'] = badge
+    if 'points' not in fields:
+        for result in results:
+            del result['points']
     return result_ok(results)
 
 @ApiController.route('/api/user/<int:uid>')
@@ -114,36 +110,71 @@ def api_get_articles(uid: int):
     if not user: return result_error("User doesn't exist", 404)
 
     page = request.args.get("p", 0, int)
+    after = decode_cursor(request.args.get("after", None, str))
     article_type = request.args.get("t", "translation", str)
     sort = request.args.get("s", "latest", str)
 
     is_correction = article_type == 'correction'
+    projection = CORRECTION if is_correction else ARTICLE
+    fields = projection.parse_fields(request.args.get("fields", None, str))
+    if not fields:
+        return result_error('Invalid fields')
 
+    # Corrections are read straight from the articles, the Correction view is the same rows
     match article_type:
         case 'translation':
             select = Article.select().where((Article.is_original == False) & (Article.author == user))
         case 'correction':
-            select = Correction.select().where(Correction.corrector == user)
+            select = Article.select().where(Article.corrector == user)
         case 'original':
             select = Article.select().where((Article.is_original == True) & (Article.author == user))
         case _:
             return result_error('Invalid type')
 
-    # Count the articles before we offset and limit
-    total = select.count()
-    select = select.limit(PAGE_ITEMS).offset(PAGE_ITEMS*page)
-
     match sort:
         case 'az':
-            select = select.order_by(Correction.name.collate("NOCASE") if is_correction else Article.name.collate("NOCASE").asc()).prefetch(User)
+            key, descending = Article.name.collate("NOCASE"), False
         case 'words':
-            select = select.order_by(Correction.words.desc() if is_correction else Article.words.desc()).prefetch(User)
-        case 'latest':
-            select = select.order_by(Correction.timestamp.desc() if is_correction else Article.added.desc()).prefetch(User)
+            key, descending = Article.words, True
         case _:
-            select = select.order_by(Correction.timestamp.desc() if is_correction else Article.added.desc()).prefetch(User)
+            # Older corrections might not have a timestamp, NULLs can't be compared in the cursor
+            key, descending = fn.IFNULL(Article.corrected, '') if is_correction else Article.added, True
 
-    return result_ok([r.to_dict() for r in select], {"total": total})
+    select = keyset_page(projection.apply(select, fields), key, Article.id, descending, after)
+    # Page numbers are still accepted for older clients
+    if after is None:
+        select = select.offset(PAGE_ITEMS*page)
+    results, next_cursor = split_page(select)
+
+    extra_data = {"next": encode_cursor(*next_cursor) if next_cursor else None}
+    # The total is always sent with page numbers, cursor clients have to ask for it
+    if after is None or request.args.get("count", 0, int):
+        # The counts are kept up to date in the leaderboard, no need to count the articles again
+        stats = get_user_stats(uid)
+        extra_data["total"] = getattr(stats, TOTAL_COLUMNS[article_type]) if stats else 0
+
+    return result_ok(projection.serialize(results, fields), extra_data)
+
+@ApiController.route('/api/import/<kind>', methods=['POST'])
+@login_required
+def bulk_import(kind: str):
+    if kind not in IMPORTERS:
+        return result_error('Invalid type', 404)
+    # Either an uploaded file or the raw request body
+    upload = request.files.get('file')
+    data = upload.read().decode('utf-8-sig') if upload else request.get_data(as_text=True)
+    is_json = request.is_json or (upload is not None and upload.filename.endswith('.json'))
+    dry_run = bool(request.args.get('dry_run', 0, int))
+    try:
+        records = parse_records(data, ImportFormat(request.args.get('format', 'json' if is_json else 'csv', str)))
+    except ValueError as e:
+        return result_error(f'Invalid data ({str(e)})')
+
+    result = IMPORTERS[kind](records, dry_run=dry_run)
+    if not dry_run and current_app.config['WEBHOOK_ENABLE']:
+        notify_promotions(result.promotions)
+    info(f"Bulk import of {result.inserted} {kind} ({len(result.skipped)} skipped{', dry run' if dry_run else ''}) by {current_user.nickname} (ID: {current_user.get_id()})")
+    return result_ok(result.to_dict())
 
 @ApiController.route('/api/user/<int:uid>/assign-correction', methods=['POST'])
 @login_required
@@ -162,8 +193,12 @@ def assign_correction(uid: int):
         return result_error('Neplatný uživatel')
     article.corrected = datetime.now()
     article.corrector = corrector
-    article.save()
-    info(f"Assigning correction of \"{article.name}\" ({article.id}) to {corrector.nickname} ({corrector.uid})")
+    try:
+        article.save()
+    except IntegrityError as e:
+        error(f"Couldn't assign correction of \"{article.name}\" ({article.id}): {str(e)}")
+        return result_error('Článek nelze uložit')
+    info(f"Assigning correction of \"{article.name}\" ({article.id}) to {corrector.nickname} ({corrector.id})")
     flash('Korekce zapsána')
     return result_ok()
 
@@ -178,6 +213,10 @@ def remove_correction(aid: int):
 
     article.corrected = None
     article.corrector = None
-    article.save()
+    try:
+        article.save()
+    except IntegrityError as e:
+        error(f"Couldn't remove correction of \"{article.name}\" ({article.id}): {str(e)}")
+        return result_error('Článek nelze uložit')
     flash('Korekce odstraněna')
     return result_ok()
\ No newline at end of file
@@ -10,8 +10,9 @@ from flask_login import current_user, login_required
 # Internal
 from forms import NewArticleForm, EditArticleForm, AssignCorrectionForm
 from framework.roles import get_role
-from extensions import rss, webhook
-from db import User, Article
+from extensions import rss
+from db import User, Article, get_user_stats, find_article_by_link, canonical_link
+from imports import notify_promotions
 
 ArticleController = Blueprint('ArticleController', __name__)
 
@@ -20,12 +21,12 @@ def check_role_and_notify(uid, point_amount):
     if not promoted_user:
         error(f"How the fuck does this even happen? (Sending promote notify for a nonexistent user {uid})")
         return
-    current_points = promoted_user.stats.first().points
+    stats = get_user_stats(uid)
+    current_points = stats.points if stats else 0
     current_role = get_role(current_points)
     next_role = get_role(current_points + point_amount)
     if current_role != next_role:
-        if promoted_user.discord:
-            webhook.send_text(f'Uživatel {promoted_user.nickname} (<@{promoted_user.discord}>) dosáhl hranice pro roli {next_role["name"]}!')
+        notify_promotions([(promoted_user, next_role)])
 
 @ArticleController.route('/article/<int:aid>/delete', methods=["POST"])
 @login_required
@@ -59,6 +60,10 @@ def add_article(uid):
     if Article.select().where(Article.name == title).exists():
         flash(f'Překlad již existuje! (od uživatele {Article.get(Article.name == title).author.nickname})')
         return redirect(url_for('ArticleController.add_article', uid=uid))
+
+    if (duplicate := find_article_by_link(form.link.data)):
+        flash(f'Článek s tímto odkazem již existuje! ({duplicate.name})')
+        return redirect(url_for('ArticleController.add_article', uid=uid))
     
     if current_app.config['WEBHOOK_ENABLE'] and not is_original:
         check_role_and_notify(uid, form.words.data / 1000 + form.bonus.data)
@@ -97,6 +102,11 @@ def edit_article(aid: int):
     if not form.validate_and_flash():
         return redirect(url_for('UserController.user', uid=article.author.get_id()))
 
+    # Only checked for a new link, an old duplicate can still be edited
+    if canonical_link(form.link.data) != canonical_link(article.link) and (duplicate := find_article_by_link(form.link.data, exclude=aid)):
+        flash(f'Článek s tímto odkazem již existuje! ({duplicate.name})')
+        return redirect(url_for('UserController.user', uid=article.author.get_id()))
+
     point_diff = (form.words.data - article.words)/1000 + (form.bonus.data - article.bonus)
     if point_diff > 0:
         check_role_and_notify(article.author.id, point_diff)
@@ -128,6 +138,10 @@ def assign_correction():
         flash('Nastala chyba, zkuste to znovu')
         return back_to_changes
 
+    if canonical_link(form.link.data) != canonical_link(article.link) and (duplicate := find_article_by_link(form.link.data, exclude=article.id)):
+        flash(f'Článek s tímto odkazem již existuje! ({duplicate.name})')
+        return back_to_changes
+
     article.link = form.link.data
     # TODO: Duplicate titles allowed on wiki but not in db, might mess shit up one day
     article.name = form.title.data
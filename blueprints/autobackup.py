@@ -14,6 +14,9 @@ from extensions import portainer, webhook
 from connectors.wikicomma import Status, Message, MessageType, ErrorKind, generate_config
 from db import WikiCommaConfig, Wiki, Backup, User
 from crypto import sign_file, get_fingerprint
+from db_snapshot import snapshot_config, create_snapshot
+from snapshot_store import snapshot_store
+from exports import ExportFormat, ExportCompression, export_table
 from framework.api.schemas.backup_schema import status_message_schema, backup_config_schema
 import utils
 
@@ -69,9 +72,16 @@ def finish_backup():
             archive.writeall(current_app.config['BACKUP']['BACKUP_COMMON_PATH'], 'backup')
             # Add all snapshots to the backup
             snapshot_path = os.path.join(os.getcwd(), 'temp', 'snapshots')
-            if utils.config_has_key(current_app.config, "BACKUP.save_snapshots", True) and os.path.isdir(snapshot_path):
-                archive.writeall(snapshot_path, 'snapshots')
-                snapshot_count = utils.count_files_rec(snapshot_path)
+            if utils.config_has_key(current_app.config, "BACKUP.save_snapshots", True):
+                if os.path.isdir(snapshot_path):
+                    archive.writeall(snapshot_path, 'snapshots')
+                # The blobs are named by hash, the manifest says which page they belong to
+                # It's in the database copy as well, but that one is optional
+                archive.writestr(b"".join(export_table('snapshots', ExportFormat.CSV, ExportCompression.NONE)), 'snapshots/manifest.csv')
+                snapshot_count = snapshot_store.count()
+            # Add a consistent copy of our own database
+            if snapshot_config(current_app.config)['INCLUDE_IN_BACKUP']:
+                archive.write(create_snapshot(current_app.config), 'database/scp.db.zst')
         # Hash the archive with SHA-1 and save that for later
         with open(archive_path, 'rb') as archive:
             hash = hashlib.sha1(archive.read()).hexdigest()
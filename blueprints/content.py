@@ -5,12 +5,15 @@ ContentController = Blueprint('ContentController', __name__)
 
 PROFILE_DIR = path.join(getcwd(), 'temp', 'avatar')
 
+# Avatars are only downloaded every 3 days, browsers can keep them for that long
+AVATAR_MAX_AGE = 3*24*60*60
+
 @ContentController.route('/content/avatar/<int:uid>')
 def get_avatar(uid: int):
     if path.exists(path.join('temp', 'avatar', f'{str(uid)}.png')): 
         if request.args.get('s', default='full', type=str) == 'thumb':
-            return send_from_directory(PROFILE_DIR, f'{str(uid)}_thumb.png')
+            return send_from_directory(PROFILE_DIR, f'{str(uid)}_thumb.png', max_age=AVATAR_MAX_AGE)
         else:
-            return send_from_directory(PROFILE_DIR, f'{str(uid)}.png')
+            return send_from_directory(PROFILE_DIR, f'{str(uid)}.png', max_age=AVATAR_MAX_AGE)
     else:
-        return send_from_directory('static', 'discord_default.png')
\ No newline at end of file
+        return send_from_directory('static', 'discord_default.png', max_age=AVATAR_MAX_AGE)
\ No newline at end of file
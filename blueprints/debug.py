@@ -1,14 +1,18 @@
 from http import HTTPStatus
 from logging import critical, warning, error, info
-from flask import Blueprint, redirect, url_for, current_app, request, render_template, send_from_directory, flash, abort
+from flask import Blueprint, Response, redirect, url_for, current_app, request, render_template, send_from_directory, flash, abort, stream_with_context
 from flask_login import login_required, current_user
-from db import Backup
+from db import Backup, database, rebuild_leaderboard
 from datetime import datetime
 import os
 
-from connectors.wikidotsite import snapshot_all
+from connectors.wikidotsite import snapshot_all, SNAPSHOT_ALL_BATCH
 from connectors.portainer import PortainerError
-from extensions import sched, webhook, portainer
+from extensions import sched, webhook, portainer, rss, snapshot_queue
+from caching import cache_stats
+from exports import EXPORTS, ExportFormat, ExportCompression, export_table, export_filename, export_mimetype
+from db_snapshot import export_snapshot
+from snapshot_store import snapshot_store
 
 DebugToolsController = Blueprint('DebugToolsController', __name__)
 
@@ -41,7 +45,9 @@ def updaterss():
 @DebugToolsController.route('/debug')
 @login_required
 def debug_index():
-    return render_template('debug/tools.j2')
+    return render_template('debug/tools.j2', lock_stats=database.lock_stats, cache_stats=cache_stats(), feed_stats=rss.feed_stats,
+                           snapshot_depth=snapshot_queue.depth(), snapshot_stats=snapshot_queue.stats,
+                           snapshot_all_progress=snapshot_queue.progress(SNAPSHOT_ALL_BATCH))
 
 @DebugToolsController.route('/debug/test_webhook')
 @login_required
@@ -57,9 +63,52 @@ def webhook_testing():
 @DebugToolsController.route('/debug/db/export')
 @login_required
 def export_database():
-    download_name=datetime.strftime(datetime.now(), 'scp_%d_%m_%Y.db')
+    download_name=datetime.strftime(datetime.now(), 'scp_%d_%m_%Y.db.zst')
+    info(f"Database exported by {current_user.nickname} (ID: {current_user.get_id()})")
     flash("Databáze exportována!")
-    return send_from_directory(os.path.join(os.getcwd(), 'data'), 'scp.db', as_attachment=True, download_name=download_name)
+    # Copied with the backup API, the live file can change while it's being sent
+    return Response(export_snapshot(current_app.config), mimetype='application/zstd',
+                    headers={'Content-Disposition': f'attachment; filename={download_name}'})
+
+@DebugToolsController.route('/debug/db/export/<table>')
+@login_required
+def export_table_stream(table: str):
+    if table not in EXPORTS: abort(HTTPStatus.NOT_FOUND)
+    try:
+        export_format = ExportFormat(request.args.get('format', ExportFormat.CSV, str))
+        compression = ExportCompression(request.args.get('compress', ExportCompression.NONE, str))
+    except ValueError:
+        abort(HTTPStatus.BAD_REQUEST)
+    filename = export_filename(table, datetime.strftime(datetime.now(), '%d_%m_%Y'), export_format, compression)
+    info(f"Table {table} exported as {filename} by {current_user.nickname} (ID: {current_user.get_id()})")
+    # The request context (and its database connection) stays open until the whole export is sent
+    return Response(stream_with_context(export_table(table, export_format, compression)),
+                    mimetype=export_mimetype(export_format, compression),
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+@DebugToolsController.route('/debug/snapshots/<wiki>/<slug>')
+@login_required
+def read_page_snapshot(wiki: str, slug: str):
+    text = snapshot_store.read(wiki, slug, request.args.get('rev', type=int))
+    if text is None: abort(HTTPStatus.NOT_FOUND)
+    return Response(text, mimetype='text/plain')
+
+@DebugToolsController.route('/debug/snapshots/<wiki>/<slug>/diff')
+@login_required
+def diff_page_snapshots(wiki: str, slug: str):
+    old_revision, new_revision = request.args.get('from', type=int), request.args.get('to', type=int)
+    if old_revision is None or new_revision is None: abort(HTTPStatus.BAD_REQUEST)
+    diff = snapshot_store.diff(wiki, slug, old_revision, new_revision)
+    if diff is None: abort(HTTPStatus.NOT_FOUND)
+    return Response(diff, mimetype='text/plain')
+
+@DebugToolsController.route('/debug/db/rebuild_leaderboard')
+@login_required
+def rebuild_leaderboard_table():
+    count = rebuild_leaderboard()
+    info(f"Leaderboard rebuilt by {current_user.nickname} (ID: {current_user.get_id()})")
+    flash(f"Žebříček přepočítán ({count} uživatelů)")
+    return redirect(request.referrer or url_for('DebugToolsController.debug_index'))
 
 @DebugToolsController.route('/debug/backup/test_portainer')
 @login_required
@@ -122,7 +171,13 @@ def force_end_backup():
     return redirect(request.referrer or url_for('LeaderboardController.index'))
 
 @DebugToolsController.route('/debug/backup/snapshot_all')
+@login_required
 def make_all_snapshots():
-    snapshot_all()
-    flash("Snímky vytvořeny")
+    # Only queued here, the jobs are stored in the database and downloaded by the workers started with the app
+    queued = snapshot_all(snapshot_queue)
+    info(f"Snapshots of all translations queued by {current_user.nickname} (ID: {current_user.get_id()})")
+    if snapshot_queue.running:
+        flash(f"Naplánováno {queued} snímků, stahují se na pozadí")
+    else:
+        flash(f"Naplánováno {queued} snímků, stáhnou se po spuštění snímkování")
     return redirect(request.referrer or url_for('LeaderboardController.index'))
\ No newline at end of file
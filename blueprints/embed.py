@@ -4,7 +4,8 @@ from enum import StrEnum
 from os import getcwd, path, listdir
 import json
 
-from db import User, Article
+from db import User, Article, user_version, last_modified, get_user_stats
+from caching import cached_view, conditional_view, data_etag
 
 EmbedController = Blueprint('EmbedController', __name__)
 EMBED_TEMPLATE_PATH = path.join(getcwd(), 'templates', 'embeds')
@@ -35,13 +36,21 @@ def get_template(template_type: EmbedType, theme: str = "default"):
         # Don't abort on invalid theme, just use the default
         return f"embeds/{template_type}/default.j2"
 
+def badge_validators(uid: int, **_):
+    # The badge only shows the user's own data, so it only changes with their version
+    version = user_version(uid)
+    if version is None: abort(HTTPStatus.NOT_FOUND)
+    return data_etag('user', uid, version), last_modified()
+
 @EmbedController.route('/user/<int:uid>/embed', methods=["GET"])
+@conditional_view(badge_validators, anonymous_only=False)
+@cached_view(anonymous_only=False)
 def user_badge(uid: int):
     embed_type = request.args.get("type", type=str, default=EmbedType.TRANSLATOR)
     if embed_type not in list(EmbedType): abort(HTTPStatus.BAD_REQUEST) # Abort on invalid type
     embed_theme = request.args.get("theme", type=str, default="default")
     user = User.get_or_none(User.id == uid) or abort(HTTPStatus.NOT_FOUND)
-    stats = user.stats.first()
+    stats = get_user_stats(uid)
     last = user.articles.where(Article.is_original == (embed_type != EmbedType.TRANSLATOR)).order_by(Article.added.desc()).first()
     return render_template(get_template(embed_type, embed_theme), user=user, stats=stats, last=last)
 
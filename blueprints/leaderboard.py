@@ -4,14 +4,26 @@ from flask import Blueprint, request, render_template
 # Internal
 import db
 from db import User
+from utils import encode_cursor, decode_cursor
+from caching import cached_view, conditional_view
+from framework.roles import role_badges
 
 LeaderboardController = Blueprint('LeaderboardController', __name__)
 
 @LeaderboardController.route('/')
+@conditional_view()
+@cached_view()
 def index():
     sort = request.args.get('sort', type=str, default='points')
     page = request.args.get('p', type=int, default=0)
+    after = decode_cursor(request.args.get('after', type=str))
     user_count = User.select().count()
     last_update = db.last_update().strftime("%Y-%m-%d %H:%M:%S")
-    data = db.get_frontpage(sort, page)
-    return render_template('users.j2', users=data, lastupdate=last_update, user_count=user_count, sort=sort)
\ No newline at end of file
+    # Old links still use page numbers, the cursor is used when present
+    if after is not None:
+        data, next_cursor = db.get_frontpage_after(sort, after)
+    else:
+        data, next_cursor = db.get_frontpage(sort, page)
+    next_page = encode_cursor(*next_cursor) if next_cursor else None
+    badges = role_badges([entry.points for entry in data])
+    return render_template('users.j2', users=data, badges=badges, lastupdate=last_update, user_count=user_count, sort=sort, next_page=next_page)
\ No newline at end of file
@@ -1,18 +1,29 @@
 from logging import info, warning
+from urllib.parse import urlparse
 from flask import Blueprint, render_template, redirect, url_for, request
 from flask_login import login_required, current_user
 
+from db import RssUpdateStatus, get_rss_updates
 from extensions import rss, sched
 from forms import AssignCorrectionForm
+from connectors.rss import RSSUpdateType
+from utils import encode_cursor, decode_cursor
 
 RssPageController = Blueprint('RssPageController', __name__)
 
-# TODO: Create db table for RSS updates
-
 @RssPageController.route('/changes')
 @login_required
 def rss_changes():
-    return render_template('changes.j2', changes=rss.updates, form=AssignCorrectionForm())
+    update_type = request.args.get('type', type=int)
+    if update_type not in (RSSUpdateType.RSS_NEWPAGE, RSSUpdateType.RSS_CORRECTION):
+        update_type = None
+    feed = request.args.get('feed', type=str)
+    after = decode_cursor(request.args.get('after', type=str))
+    changes, next_cursor = get_rss_updates(update_type, feed, after)
+    next_page = encode_cursor(*next_cursor) if next_cursor else None
+    feeds = [(link, urlparse(link).netloc) for link in rss.links]
+    return render_template('changes.j2', changes=changes, form=AssignCorrectionForm(), update_type=update_type,
+                           feed=feed, feeds=feeds, next_page=next_page)
 
 @RssPageController.route('/changes/ignore')
 @login_required
@@ -20,7 +31,7 @@ def ignore_update():
     uuid = request.args.get('u', None)
     if not uuid:
         return redirect(url_for('RssPageController.rss_changes'))
-    title = rss.remove_update(uuid)
+    title = rss.remove_update(uuid, RssUpdateStatus.IGNORED)
     if not title:
         warning(f'Removing non-existent RSS Update with UUID {uuid}')
     else:
@@ -1,8 +1,12 @@
 from flask import render_template, Blueprint
-from db import Statistics, Series
+from db import get_series_stats, get_global_stats
+from caching import cached_view, conditional_view
 
 StatisticsController = Blueprint('StatisticsController', __name__)
 
 @StatisticsController.route('/stats')
+@conditional_view()
+@cached_view()
 def view_stats():
-    return render_template('stats.j2', series_info=Series.select(), global_stats=Statistics.select().first())
\ No newline at end of file
+    series_info = get_series_stats()
+    return render_template('stats.j2', series_info=series_info, global_stats=get_global_stats(series_info))
\ No newline at end of file
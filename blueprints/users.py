@@ -3,13 +3,14 @@ from peewee import IntegrityError
 from flask import Blueprint, url_for, redirect, session, request, render_template, abort, flash, current_app
 from forms import NewUserForm, EditUserForm
 from flask_login import current_user, login_required
-from db import User, Article
+from db import User, Article, get_user_stats
 from logging import info, error
 from crypto import pw_hash
 from tasks import discord_tasks
 from secrets import token_urlsafe
 
 from extensions import sched, webhook
+from caching import cached_view, conditional_view
 
 UserController = Blueprint('UserController', __name__)
 
@@ -72,6 +73,8 @@ def edit_user(uid: int):
     return redirect(url_for('UserController.user', uid=uid))
 
 @UserController.route('/user/<int:uid>')
+@conditional_view()
+@cached_view()
 def user(uid: int):
     sort = request.args.get('sort', 'latest', str)
     user = User.get_or_none(User.id == uid) or abort(HTTPStatus.NOT_FOUND)
@@ -79,7 +82,7 @@ def user(uid: int):
     # TODO: Extract constant
     translations = list(user.articles.where(Article.is_original == False).order_by(Article.added.desc()).limit(15).prefetch(User))
     originals = list(user.articles.where(Article.is_original == True).prefetch(User))
-    return render_template('user.j2', user=user, stats=user.stats.first(), translations=translations, corrections=corrections, originals=originals, sort=sort)
+    return render_template('user.j2', user=user, stats=get_user_stats(uid), translations=translations, corrections=corrections, originals=originals, sort=sort)
 
 # TODO: Make this and some other destructive routes POST-only
 # TODO: Maybe just hide users instead of deleting them as to not fuck up DB integrity
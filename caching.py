@@ -0,0 +1,215 @@
+"""
+In-memory response cache and HTTP validators
+
+Views decorated with cached_view are stored under a key built from the endpoint, its arguments,
+the auth state and the data state stored in the database, so any write to Article or User (from any process)
+makes the old entries unreachable and the LRU eviction eventually drops them
+
+Views decorated with conditional_view get an ETag derived from the versions stored in the database
+and answer 304 without rendering the page
+"""
+
+import datetime
+import pickle
+import time
+from typing import Callable
+from functools import wraps
+from threading import Lock
+from logging import debug
+
+from cachetools import LRUCache as LRUStore
+from flask import request, session, current_app, make_response, g
+from werkzeug.http import is_resource_modified
+from flask_caching.backends.base import BaseCache
+from flask_login import current_user
+
+from db import data_state, last_modified
+from constants import APP_VERSION
+from extensions import cache
+
+# Defaults for the "CACHE" config key
+DEFAULT_CACHE_CONFIG = {
+    "ENABLE": True,
+    "MAX_SIZE": 32*1024*1024,   # Bytes of pickled values kept in memory
+    "TIMEOUT": 3600,            # Entries expire after this many seconds even if nothing changed
+}
+
+class CountingLRUStore(LRUStore):
+    def __init__(self, maxsize, getsizeof=None):
+        super().__init__(maxsize, getsizeof)
+        self.evictions = 0
+
+    def popitem(self):
+        self.evictions += 1
+        return super().popitem()
+
+class LRUCache(BaseCache):
+    """
+    Flask-Caching backend bounded by the total size of the stored values, least recently used entries go first
+    """
+
+    def __init__(self, max_size: int = DEFAULT_CACHE_CONFIG['MAX_SIZE'], default_timeout: int = 300):
+        super().__init__(default_timeout=default_timeout)
+        # Values are stored pickled, so their size is simply the length
+        self._store = CountingLRUStore(max_size, getsizeof=lambda entry: len(entry[1]))
+        self._mutex = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def factory(cls, app, config, args, kwargs):
+        kwargs.update(max_size=config['CACHE_MAX_SIZE'], default_timeout=config['CACHE_DEFAULT_TIMEOUT'])
+        return cls(*args, **kwargs)
+
+    def _expires(self, timeout) -> float:
+        timeout = self._normalize_timeout(timeout)
+        return time.monotonic() + timeout if timeout > 0 else float('inf')
+
+    def get(self, key):
+        with self._mutex:
+            entry = self._store.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self.misses += 1
+                return None
+            self.hits += 1
+        return pickle.loads(entry[1])
+
+    def set(self, key, value, timeout=None):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self._mutex:
+            try:
+                self._store[key] = (self._expires(timeout), data)
+            except ValueError:
+                # Bigger than the whole cache
+                return False
+        return True
+
+    def add(self, key, value, timeout=None):
+        with self._mutex:
+            if key in self._store:
+                return False
+        return self.set(key, value, timeout)
+
+    def delete(self, key):
+        with self._mutex:
+            return self._store.pop(key, None) is not None
+
+    def has(self, key):
+        with self._mutex:
+            entry = self._store.get(key)
+            return entry is not None and entry[0] >= time.monotonic()
+
+    def clear(self):
+        with self._mutex:
+            self._store.clear()
+        return True
+
+    @property
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {
+            'entries': len(self._store),
+            'size': self._store.currsize,
+            'max_size': self._store.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self._store.evictions,
+            'hit_rate': self.hits / requests if requests else 0.0
+        }
+
+def cache_config(config: dict) -> dict:
+    cache_config = DEFAULT_CACHE_CONFIG | config.get('CACHE', {})
+    return {
+        'CACHE_TYPE': 'caching.LRUCache' if cache_config['ENABLE'] else 'NullCache',
+        'CACHE_MAX_SIZE': cache_config['MAX_SIZE'],
+        'CACHE_DEFAULT_TIMEOUT': cache_config['TIMEOUT'],
+    }
+
+def init_app(app) -> None:
+    cache.init_app(app, config=cache_config(app.config))
+
+def cache_stats() -> dict | None:
+    """
+    Hit and size counters of the cache backend, None if the cache is disabled
+    """
+    return getattr(cache.cache, 'stats', None)
+
+def request_data_state() -> str:
+    # Read once per request, conditional_view and cached_view both need it
+    if 'data_state' not in g:
+        g.data_state = data_state()
+    return g.data_state
+
+def view_cache_key() -> str:
+    args = '&'.join(f"{k}={v}" for k, v in sorted(request.args.items(multi=True)))
+    auth = current_user.get_id() if current_user.is_authenticated else 'anon'
+    # The state is read before the view runs, so a write that commits in the meantime can only make the entry newer
+    # Not data_version, that one only counts the writes of this process
+    return f"view:{request.endpoint}:{request.view_args}:{args}:{auth}:{request_data_state()}"
+
+def data_etag(*parts) -> str:
+    # Templates change between releases, so the version is part of every ETag
+    return '-'.join(str(part) for part in (APP_VERSION, *parts))
+
+def page_validators(**_) -> tuple[str, datetime.datetime]:
+    """
+    Validators for pages built from the whole database
+    """
+    # Not data_version, that one starts from zero in every process and would match ETags from before a restart
+    return data_etag(request_data_state()), last_modified()
+
+def conditional_view(validators: Callable = page_validators, anonymous_only: bool = True):
+    """
+    Adds an ETag and Last-Modified to the response and answers 304 when the client's copy is still current
+
+    validators gets the view arguments and returns the ETag and last modification time,
+    it should do as little work as possible because it runs before the view on every request
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if (anonymous_only and current_user.is_authenticated) or session.get('_flashes'):
+                return view(*args, **kwargs)
+            etag, modified = validators(**kwargs)
+            if not is_resource_modified(request.environ, etag=etag, last_modified=modified):
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            response.last_modified = modified
+            # Revalidate every time, the 304 is cheap
+            response.cache_control.no_cache = True
+            response.cache_control.public = not anonymous_only
+            if anonymous_only:
+                response.vary.add('Cookie')
+            return response
+        return wrapper
+    return decorator
+
+def cached_view(anonymous_only: bool = True):
+    """
+    Caches the response of a view until the data version changes
+
+    Pages render things like the menu differently for logged in users, those are only cached
+    if anonymous_only is False. Responses with flashed messages are never cached.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if (anonymous_only and current_user.is_authenticated) or session.get('_flashes'):
+                return view(*args, **kwargs)
+            key = view_cache_key()
+            cached = cache.get(key)
+            if cached is not None:
+                body, status, mimetype = cached
+                return current_app.response_class(body, status=status, mimetype=mimetype)
+            response = make_response(view(*args, **kwargs))
+            if response.status_code == 200 and not response.direct_passthrough:
+                cache.set(key, (response.get_data(), response.status_code, response.mimetype))
+            else:
+                debug(f"Not caching {request.path} (status {response.status_code})")
+            return response
+        return wrapper
+    return decorator
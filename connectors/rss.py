@@ -4,22 +4,23 @@ import re
 from logging import debug, info, error, warning, debug
 from datetime import datetime, timedelta
 from dataclasses import dataclass
-from uuid import uuid4, UUID
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+import time
 from flask import Flask
 from enum import IntEnum
 from typing import Optional
-from collections import deque
+from uuid import UUID
 from urllib.parse import urlparse, urlunparse
 
 # Internal
-from db import User, Article, last_update
-import connectors.wikidotsite as wikidotsite
+from db import database, User, Article, RssUpdate, RssUpdateStatus, RssSeenGuid, last_update, find_user_by_wikidot_slug, find_article_by_link
 from utils import config_has_key
 
 # External
 import requests
 import feedparser
-from peewee import fn
+import httpx
 
 # Extract the actual title from the feed's title element
 r_title = re.compile(r"\"(.+)\".+", re.UNICODE)
@@ -33,6 +34,11 @@ PAGE_RENAME = 'přesunout/přejmenovat stránku' # This text in the title indica
 CORRECTION_COMPLETE = 'Odstraněné štítky: korekce'
 IGNORE_BRANCH_TAG = '-cs' # Ignore new pages that start with this tag, doesn't work for tales but I don't really care
 TIMEZONE_UTC_OFFSET = timedelta(hours=2)
+# Processed GUIDs are forgotten once they've been out of every feed for this long
+SEEN_GUID_RETENTION = timedelta(days=90)
+# Feeds downloaded at the same time
+FETCH_WORKERS = 8
+FETCH_TIMEOUT = 30
 
 class RSSUpdateType(IntEnum):
     RSS_NEWPAGE = 0
@@ -43,20 +49,61 @@ class RSSUpdateType(IntEnum):
     RSS_UNKNOWN = 5
 
 @dataclass
-class RSSUpdate:
-    timestamp: datetime
+class FeedState:
+    """
+    HTTP validators and fetch statistics of one feed
+    """
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    # HTTP status of the last fetch, None if it failed before getting a response
+    status: Optional[int] = None
+    error: Optional[str] = None
+    last_fetch: Optional[datetime] = None
+    latency: float = 0.0
+    total_latency: float = 0.0
+    fetches: int = 0
+    not_modified: int = 0
+    failures: int = 0
+
+    @property
+    def average_latency(self) -> float:
+        return self.total_latency / self.fetches if self.fetches else 0.0
+
+    def request_headers(self) -> dict:
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+    def record(self, status: Optional[int], latency: float, error: Optional[str] = None) -> None:
+        self.status = status
+        self.error = error
+        self.last_fetch = datetime.now()
+        self.latency = latency
+        self.total_latency += latency
+        self.fetches += 1
+        if status == 304:
+            self.not_modified += 1
+        elif status is None or status >= 400:
+            self.failures += 1
+
+@dataclass
+class FeedResponse:
     link: str
-    title: str
-    author: User
-    uuid: UUID
-    update_type: RSSUpdateType
+    entries: Optional[list]
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
 
 class RSSMonitor:
     
     def __init__(self, links: List[str] = []):
         self.__links = links
-        self.__updates = list() #TODO: Make this a dict indexed by the GUID
-        self.__finished_guids = deque(maxlen=255)
+        # GUID -> when it was last in a feed, loaded from RssSeenGuid on the first check
+        self.__seen_guids = None
+        self.__feed_states = {}
+        self.__feed_mutex = Lock()
         # Maps domains to the names of wikis translated from
         self.__source_wiki_map = {}
         self.__save_snapshots = False
@@ -74,6 +121,7 @@ class RSSMonitor:
         if self.__save_snapshots:
             debug(f"Mapped source wikis: {self.__source_wiki_map}")
         self.__webhook = app.config['webhook']
+        self.__snapshots = app.config['snapshot_queue']
 
         info(f'Loaded {len(self.__links)} RSSMonitor endpoints from config')
 
@@ -90,35 +138,20 @@ class RSSMonitor:
             return RSSUpdateType.RSS_UNKNOWN
     
     # Wikidot always converts the username to lowercase and replaces spaces/underscores with dashes for the url slug
-    # Makes finding users kinda a pain in the ass
+    # so users are matched by the same form of their username
     def get_rss_update_author(self, update: dict) -> Optional[User]:
         update_description = update['description']
-        username = r_user.search(update_description).group(1).lower()
+        username = r_user.search(update_description).group(1)
         debug(f"Extracted username \"{username}\"")
-        user = User.get_or_none(fn.LOWER(User.wikidot) == username) # Spaces and underscores get replaced with dashes in the URL, there's no way around this unfortunately
-        if not user: #! This is going to break if a user has two of these symbols in their name
-            username = username.replace('-', ' ')
-            user = User.get_or_none(fn.LOWER(User.wikidot) == username)
-        if not user:
-            username = username.replace(' ', '_')
-            user = User.get_or_none(fn.LOWER(User.wikidot) == username)
+        user = find_user_by_wikidot_slug(username)
         if not user:
             debug(f"Failed to find user \"{username}\"")
         return user
     
-    # Try both http and https scheme, Wikidot is the only site in existence
-    # that isn't all HTTPS in 2025, so they tend to get mixed up
-    # Using urllib functions for this would be good practice but fuck it tbh
+    # Links are compared in their canonical form, so http/https, www. and trailing slashes don't matter
     @staticmethod
     def find_link(link: str) -> Optional[Article]:
-        article = Article.get_or_none(Article.link == link)
-        if not article:
-            if link.startswith("https"):
-                link = link.replace("https", "http", 1)
-            else:
-                link = link.replace("http", "https", 1)
-            article = Article.get_or_none(Article.link == link)
-        return article
+        return find_article_by_link(link)
         
     @staticmethod
     def get_rss_update_title(update: dict) -> str:
@@ -132,7 +165,15 @@ class RSSMonitor:
     def get_update_revision(update: dict) -> int:
         return update['guid'].split('#')[1].removeprefix("revision-")
 
-    def _process_new_page(self, update) -> bool:
+    @staticmethod
+    def queue_update(update: dict, feed: str, timestamp: datetime, title: str, author: User, update_type: RSSUpdateType) -> bool:
+        """
+        Saves an update for someone to review, returns False if the feed entry was already queued before
+        """
+        return RssUpdate.insert(guid=update['guid'], feed=feed, update_type=update_type, title=title, link=update['link'],
+                                author=author, timestamp=timestamp).on_conflict_ignore().as_rowcount().execute() > 0
+
+    def _process_new_page(self, update, feed: str) -> bool:
         timestamp = RSSMonitor.get_rss_update_timestamp(update)
         title = RSSMonitor.get_rss_update_title(update)
         author = self.get_rss_update_author(update)
@@ -141,8 +182,8 @@ class RSSMonitor:
 
         if self.__save_snapshots:
             source_wiki = urlparse(link).netloc
-            if wikidotsite.source_page_exists(link, self.__source_wiki_map[source_wiki]):
-                wikidotsite.snapshot_original(link, revision_id=revision, source_wiki_name=self.__source_wiki_map[source_wiki])
+            # Downloaded in the background, a slow Wikidot response shouldn't hold up the feed
+            self.__snapshots.enqueue(link, self.__source_wiki_map[source_wiki], int(revision))
 
         if not author:
             info(f'Ignoring {title} in RSS feed (couldn\'t match wikidot username {author} to a user)')
@@ -153,11 +194,10 @@ class RSSMonitor:
             if RSSMonitor.find_link(link):
                 info(f'Ignoring {title} in RSS feed (added manually)')
                 return False
-            self.__updates.append(RSSUpdate(timestamp+TIMEZONE_UTC_OFFSET, link, title, author, uuid4(), RSSUpdateType.RSS_NEWPAGE))
-            return True
+            return RSSMonitor.queue_update(update, feed, timestamp+TIMEZONE_UTC_OFFSET, title, author, RSSUpdateType.RSS_NEWPAGE)
         return False
 
-    def _process_correction(self, update) -> bool:
+    def _process_correction(self, update, feed: str) -> bool:
         real_title = update["title"].split("\"")[1]
         author = self.get_rss_update_author(update)
         timestamp = RSSMonitor.get_rss_update_timestamp(update)
@@ -168,7 +208,7 @@ class RSSMonitor:
         else:
             translation = RSSMonitor.find_link(update['link'])
             if not translation:
-                self.__updates.append(RSSUpdate(timestamp+TIMEZONE_UTC_OFFSET, update['link'], real_title, author, uuid4(), RSSUpdateType.RSS_CORRECTION))
+                RSSMonitor.queue_update(update, feed, timestamp+TIMEZONE_UTC_OFFSET, real_title, author, RSSUpdateType.RSS_CORRECTION)
                 warning(f"Correction for {real_title} by {author.nickname} cannot be assigned to an article")
             else:
                 translation.corrector = author
@@ -176,60 +216,183 @@ class RSSMonitor:
                 translation.save()
                 info(f'Assigned correction by {author.nickname} to {translation.name}')
 
-    def _process_update(self, update) -> bool:
-        if update['guid'] in self.__finished_guids:
-            debug(f"Skip GUID {update['guid']}")
-            return False
+    def load_seen_guids(self) -> None:
+        self.__seen_guids = {guid: seen for guid, seen in RssSeenGuid.select(RssSeenGuid.guid, RssSeenGuid.seen).tuples()}
+        debug(f"Loaded {len(self.__seen_guids)} seen RSS GUIDs")
+
+    def unprocessed_entries(self, entries: list) -> list:
+        """
+        Returns the feed entries that haven't been processed yet
 
-        if update['guid'] not in self.__finished_guids:
-            debug(f"Add GUID {update['guid']}")
-            self.__finished_guids.append(update['guid'])
+        Entries seen before by this process are skipped without a query, the rest are looked up with one.
+        Nothing is written here, entries are marked with mark_processed only once they've been processed,
+        so an entry that fails is tried again on the next check
+        """
+        if self.__seen_guids is None:
+            self.load_seen_guids()
+        now = datetime.now()
+        guids = {entry['guid'] for entry in entries}
+        known = guids & self.__seen_guids.keys()
+        # Entries that are still in the feed don't get swept, the time is written by sweep_seen_guids when it matters
+        self.__seen_guids.update(dict.fromkeys(known, now))
+        new = guids - known
+        if new:
+            # Processed by another process
+            processed = {guid for (guid,) in RssSeenGuid.select(RssSeenGuid.guid).where(RssSeenGuid.guid.in_(list(new))).tuples()}
+            self.__seen_guids.update(dict.fromkeys(processed, now))
+            new -= processed
+        debug(f"{len(new)} new entries, {len(guids) - len(new)} already processed")
+        return [entry for entry in entries if entry['guid'] in new]
+
+    def mark_processed(self, guids: list[str]) -> None:
+        """
+        Remembers processed entries, all of them in one transaction
+
+        Two processes checking the same feed at once might both process an entry, which is harmless:
+        updates are queued by GUID and assigning the same correction twice changes nothing
+        """
+        if not guids:
+            return
+        now = datetime.now()
+        with database.atomic():
+            RssSeenGuid.insert_many([{'guid': guid, 'seen': now} for guid in guids]).on_conflict_ignore().execute()
+        self.__seen_guids.update(dict.fromkeys(guids, now))
+
+    def sweep_seen_guids(self) -> None:
+        """
+        Forgets GUIDs that haven't been in a feed for SEEN_GUID_RETENTION
+
+        Later sightings are only kept in memory, they're written to the rows that would be deleted otherwise
+        """
+        cutoff = datetime.now() - SEEN_GUID_RETENTION
+        if self.__seen_guids is not None:
+            self.__seen_guids = {guid: seen for guid, seen in self.__seen_guids.items() if seen >= cutoff}
+        expired = [guid for (guid,) in RssSeenGuid.select(RssSeenGuid.guid).where(RssSeenGuid.seen < cutoff).tuples()]
+        if not expired:
+            return
+        # Grouped by time, the entries of one check were all seen at once
+        still_seen = {}
+        for guid in expired:
+            if (seen := (self.__seen_guids or {}).get(guid)):
+                still_seen.setdefault(seen, []).append(guid)
+        with database.atomic():
+            for seen, guids in still_seen.items():
+                RssSeenGuid.update(seen=seen).where(RssSeenGuid.guid.in_(guids)).execute()
+            if (deleted := RssSeenGuid.delete().where(RssSeenGuid.seen < cutoff).execute()):
+                info(f"Forgot {deleted} old RSS GUIDs")
+
+    def _process_update(self, update, feed: str) -> bool:
         update_type = RSSMonitor.get_rss_update_type(update)
         match update_type:
             case RSSUpdateType.RSS_NEWPAGE:
-                if self._process_new_page(update):
+                if self._process_new_page(update, feed):
                     return True
             case RSSUpdateType.RSS_CORRECTION:
-                self._process_correction(update)
+                self._process_correction(update, feed)
 
         return False
         
+    def feed_state(self, link: str) -> FeedState:
+        with self.__feed_mutex:
+            return self.__feed_states.setdefault(link, FeedState())
+
+    def fetch_feed(self, client: httpx.Client, link: str) -> FeedResponse:
+        """
+        Downloads a feed unless it hasn't changed since the last fetch, entries are None if there's nothing to process
+        """
+        state = self.feed_state(link)
+        start = time.perf_counter()
+        try:
+            response = client.get(link, headers=state.request_headers())
+        except httpx.HTTPError as e:
+            state.record(None, time.perf_counter() - start, str(e))
+            error(f"RSS Update failed for feed {link} ({e})")
+            return FeedResponse(link, None)
+        state.record(response.status_code, time.perf_counter() - start)
+        if response.status_code == 304:
+            debug(f"Feed {link} not modified")
+            return FeedResponse(link, None)
+        if response.is_error:
+            state.error = f"HTTP {response.status_code}"
+            error(f"RSS Update failed for feed {link} (HTTP {response.status_code})")
+            return FeedResponse(link, None)
+        return FeedResponse(link, feedparser.parse(response.content).get('entries', []),
+                            response.headers.get('ETag'), response.headers.get('Last-Modified'))
+
     def check(self):
         info(f'Fetching {len(self.__links)} RSS feeds')
         if not self.__links:
             return
-        
+
+        # Only the downloads run in parallel, the entries are processed one feed at a time
+        with httpx.Client(timeout=FETCH_TIMEOUT, follow_redirects=True) as client,\
+             ThreadPoolExecutor(max_workers=min(FETCH_WORKERS, len(self.__links))) as pool:
+            responses = list(pool.map(lambda link: self.fetch_feed(client, link), self.__links))
+
         new_count = 0
-        for link in self.__links:
+        for response in responses:
+            if response.entries is None:
+                continue
+            processed, failed = [], 0
             try:
-                feed = feedparser.parse(link).get('entries')
+                for update in self.unprocessed_entries(response.entries):
+                    try:
+                        if self._process_update(update, response.link): new_count += 1
+                        processed.append(update['guid'])
+                    except Exception as e:
+                        failed += 1
+                        error(f"Couldn't process RSS entry {update.get('guid')} ({str(e)}), it will be retried on the next check")
+                self.mark_processed(processed)
             except Exception as e:
-                error(f"RSS Update failed for feed {link} ({e})")
-                
-            for update in feed:
-                if self._process_update(update): new_count += 1
+                error(f"Couldn't process RSS feed {response.link} ({str(e)})")
+                continue
+            # Saved only once every entry is processed, otherwise the next fetch could get a 304 and skip the failed ones
+            if not failed:
+                state = self.feed_state(response.link)
+                state.etag, state.last_modified = response.etag, response.last_modified
+
+        try:
+            self.sweep_seen_guids()
+        except Exception as e:
+            error(f"Couldn't forget old RSS GUIDs ({str(e)})")
 
         info(f'Got {new_count or "no"} new pages from RSS feeds')
 
     @property
-    def updates(self) -> List[RSSUpdate]:
-        return self.__updates
-    
+    def feed_stats(self) -> dict[str, FeedState]:
+        with self.__feed_mutex:
+            return dict(self.__feed_states)
+
     @property
     def update_count(self) -> int:
-        return len(self.__updates)
+        return RssUpdate.select().where(RssUpdate.status == RssUpdateStatus.PENDING).count()
     
     @property
     def has_links(self) -> bool:
         return len(self.__links) > 0
+
+    @property
+    def links(self) -> List[str]:
+        return self.__links
     
-    def remove_update(self, uuid: str) -> Optional[str]:
-        for update in self.__updates:
-            if str(update.uuid).lower() == uuid.lower():
-                debug(f'{update.link} mark finished (remove)')
-                self.__updates.remove(update)
-                return update.title
-        return None
+    def remove_update(self, uuid: str, status: RssUpdateStatus = RssUpdateStatus.DONE) -> Optional[str]:
+        """
+        Takes an update off the queue, returns its title or None if it doesn't exist or someone else got to it first
+        """
+        try:
+            uuid = UUID(uuid)
+        except (ValueError, TypeError):
+            return None
+        update = RssUpdate.get_or_none(RssUpdate.uuid == uuid)
+        if not update:
+            return None
+        # Only one request can change the status of a pending update
+        changed = RssUpdate.update(status=status, resolved=datetime.now())\
+            .where((RssUpdate.id == update.id) & (RssUpdate.status == RssUpdateStatus.PENDING)).execute()
+        if not changed:
+            return None
+        debug(f'{update.link} mark finished (remove)')
+        return update.title
 
     def flush_updates(self) -> None:
-        self.__updates.clear()
\ No newline at end of file
+        RssUpdate.update(status=RssUpdateStatus.IGNORED, resolved=datetime.now()).where(RssUpdate.status == RssUpdateStatus.PENDING).execute()
@@ -0,0 +1,243 @@
+# Builtins
+from typing import List, Optional
+from logging import info, error, warning, debug
+from datetime import datetime, timedelta
+from dataclasses import dataclass, field
+from threading import Thread, Event, Lock
+import time
+
+# Internal
+from db import database, SnapshotJob, SnapshotJobStatus
+from constants import USER_AGENT
+import connectors.wikidotsite as wikidotsite
+
+# External
+from flask import Flask
+from peewee import fn
+import requests
+import wikidot
+
+# Defaults for the "PAGE_SNAPSHOTS" config key
+DEFAULT_QUEUE_CONFIG = {
+    "WORKERS": 2,                   # Snapshots downloaded at the same time
+    "REQUESTS_PER_SECOND": 1.0,     # Requests to Wikidot shared by all workers
+    "BURST": 5,                     # Requests that can be made at once after a quiet period
+}
+# Jobs inserted per query when queueing in bulk
+ENQUEUE_CHUNK = 500
+# A failed job is retried after RETRY_DELAY, 2*RETRY_DELAY, 4*RETRY_DELAY... until it has been tried MAX_ATTEMPTS times
+MAX_ATTEMPTS = 5
+RETRY_DELAY = timedelta(minutes=5)
+# Idle workers check for retries that have become due this often (s)
+POLL_INTERVAL = 60
+# A job that has been running for this long belongs to a worker that died, it gets picked up again
+STALE_JOB_TIMEOUT = timedelta(hours=1)
+
+class TokenBucket:
+    """
+    Rate limiter shared between threads, allows rate requests per second on average and up to burst at once
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.mutex = Lock()
+
+    def acquire(self, tokens: int = 1) -> None:
+        # More than burst would never be available
+        tokens = min(tokens, self.burst)
+        while True:
+            with self.mutex:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+@dataclass
+class QueueStats:
+    """
+    What the workers of this process have done since startup
+    """
+    started: datetime = field(default_factory=datetime.now)
+    done: int = 0
+    skipped: int = 0
+    retried: int = 0
+    failed: int = 0
+    total_time: float = 0.0
+    mutex: Lock = field(default_factory=Lock, repr=False)
+
+    def record(self, status: SnapshotJobStatus, duration: float) -> None:
+        with self.mutex:
+            match status:
+                case SnapshotJobStatus.DONE: self.done += 1
+                case SnapshotJobStatus.SKIPPED: self.skipped += 1
+                case SnapshotJobStatus.PENDING: self.retried += 1
+                case SnapshotJobStatus.FAILED: self.failed += 1
+            self.total_time += duration
+
+    @property
+    def processed(self) -> int:
+        return self.done + self.skipped + self.retried + self.failed
+
+    @property
+    def average_time(self) -> float:
+        return self.total_time / self.processed if self.processed else 0.0
+
+    @property
+    def per_hour(self) -> float:
+        hours = (datetime.now() - self.started).total_seconds() / 3600
+        return self.processed / hours if hours else 0.0
+
+class SnapshotQueue:
+    """
+    Downloads snapshots of original pages in the background
+
+    Jobs are stored in the SnapshotJob table, so they survive restarts and can be queued by any process.
+    All workers share one Wikidot client and one HTTP session.
+    """
+
+    def __init__(self):
+        self.__workers: List[Thread] = []
+        self.__wakeup = Event()
+        self.__stop = Event()
+        self.__client = None
+        self.__session = None
+        self.__limiter = None
+        self.stats = QueueStats()
+
+    def init_app(self, app: Flask) -> None:
+        if self.__workers:
+            return
+        queue_config = DEFAULT_QUEUE_CONFIG | app.config.get('PAGE_SNAPSHOTS', {})
+        self.__limiter = TokenBucket(queue_config['REQUESTS_PER_SECOND'], queue_config['BURST'])
+        self.__client = wikidot.Client()
+        self.__session = requests.Session()
+        self.__session.headers['User-Agent'] = USER_AGENT
+        for number in range(queue_config['WORKERS']):
+            worker = Thread(target=self.work, name=f"snapshot-worker-{number}", daemon=True)
+            worker.start()
+            self.__workers.append(worker)
+        info(f"Started {len(self.__workers)} snapshot workers")
+
+    @property
+    def running(self) -> bool:
+        return bool(self.__workers)
+
+    def stop(self) -> None:
+        self.__stop.set()
+        self.__wakeup.set()
+        for worker in self.__workers:
+            worker.join()
+        self.__workers.clear()
+
+    def enqueue(self, url: str, source_wiki: str, revision: int = 0) -> bool:
+        """
+        Queues a snapshot, returns False if the same revision has already been queued
+        """
+        queued = SnapshotJob.insert(url=url, source_wiki=source_wiki, revision=revision)\
+            .on_conflict_ignore().as_rowcount().execute() > 0
+        if queued:
+            debug(f"Queued snapshot of {url} (revision {revision})")
+            self.__wakeup.set()
+        return queued
+
+    def enqueue_many(self, jobs: List[dict], batch: Optional[str] = None) -> int:
+        """
+        Queues snapshots in bulk, jobs are dicts with the SnapshotJob columns. Returns how many weren't queued before
+        """
+        queued = 0
+        for start in range(0, len(jobs), ENQUEUE_CHUNK):
+            chunk = [job | {'batch': batch} for job in jobs[start:start+ENQUEUE_CHUNK]]
+            with database.atomic():
+                queued += SnapshotJob.insert_many(chunk).on_conflict_ignore().as_rowcount().execute()
+        if queued:
+            self.__wakeup.set()
+        return queued
+
+    @staticmethod
+    def claim() -> Optional[SnapshotJob]:
+        """
+        Marks the next due job as running and returns it
+        """
+        now = datetime.now()
+        due = ((SnapshotJob.status == SnapshotJobStatus.PENDING) & (SnapshotJob.next_attempt <= now)) |\
+              ((SnapshotJob.status == SnapshotJobStatus.RUNNING) & (SnapshotJob.started < now - STALE_JOB_TIMEOUT))
+        # The transaction holds the write lock, so no other worker (or process) can claim the same job
+        with database.atomic():
+            job = SnapshotJob.select().where(due).order_by(SnapshotJob.next_attempt, SnapshotJob.id).first()
+            if job is None:
+                return None
+            job.status = SnapshotJobStatus.RUNNING
+            job.attempts += 1
+            job.started = now
+            job.save()
+        return job
+
+    def run_job(self, job: SnapshotJob) -> SnapshotJobStatus:
+        try:
+            self.__limiter.acquire()
+            exists = wikidotsite.source_page_exists(job.url, job.source_wiki, session=self.__session)
+            if exists is None:
+                raise RuntimeError("Couldn't check whether the original page exists")
+            if not exists:
+                job.status = SnapshotJobStatus.SKIPPED
+            else:
+                # Finding the page and getting its source are two requests
+                self.__limiter.acquire(2)
+                job.path = wikidotsite.snapshot_original(job.url, revision_id=job.revision, source_wiki_name=job.source_wiki,
+                                                         client=self.__client, fail_on_not_found=False)
+                job.status = SnapshotJobStatus.DONE if job.path else SnapshotJobStatus.SKIPPED
+            job.error = None
+        except Exception as e:
+            job.error = str(e)
+            if job.attempts < MAX_ATTEMPTS:
+                job.status = SnapshotJobStatus.PENDING
+                job.next_attempt = datetime.now() + RETRY_DELAY * 2**(job.attempts-1)
+                warning(f"Snapshot of {job.url} failed ({str(e)}), retrying at {job.next_attempt.strftime('%H:%M:%S')}")
+            else:
+                job.status = SnapshotJobStatus.FAILED
+                error(f"Snapshot of {job.url} failed {job.attempts} times, giving up ({str(e)})")
+        if job.status != SnapshotJobStatus.PENDING:
+            job.finished = datetime.now()
+        job.save()
+        return job.status
+
+    def work(self) -> None:
+        while not self.__stop.is_set():
+            job = None
+            try:
+                with database.connection_context():
+                    job = self.claim()
+                    if job is not None:
+                        start = time.perf_counter()
+                        status = self.run_job(job)
+                        self.stats.record(status, time.perf_counter() - start)
+            except Exception as e:
+                # Most likely the database was busy, the job is picked up again once it goes stale
+                error(f"Snapshot worker error ({str(e)})")
+            if job is None:
+                self.__wakeup.wait(POLL_INTERVAL)
+                self.__wakeup.clear()
+
+    @staticmethod
+    def depth() -> dict[SnapshotJobStatus, int]:
+        """
+        Number of jobs in each state
+        """
+        counts = dict(SnapshotJob.select(SnapshotJob.status, fn.COUNT(SnapshotJob.id)).group_by(SnapshotJob.status).tuples())
+        return {status: counts.get(status, 0) for status in SnapshotJobStatus}
+
+    @staticmethod
+    def progress(batch: str) -> dict[SnapshotJobStatus, int]:
+        """
+        Number of jobs of a batch in each state
+        """
+        counts = dict(SnapshotJob.select(SnapshotJob.status, fn.COUNT(SnapshotJob.id))
+                      .where(SnapshotJob.batch == batch).group_by(SnapshotJob.status).tuples())
+        return {status: counts.get(status, 0) for status in SnapshotJobStatus}
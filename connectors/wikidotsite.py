@@ -1,11 +1,13 @@
 # Builtins
 from typing import Optional
-from os import path, PathLike, getcwd
+from os import path, PathLike, getcwd, listdir
+from datetime import datetime
 from logging import info, error, warning, debug
 import re
 
 # Internal
-from db import Article
+from db import Article, SnapshotJobStatus
+from snapshot_store import snapshot_store
 from constants import USER_AGENT
 
 # External
@@ -14,23 +16,25 @@ from urllib import parse
 import wikidot
 import requests
 
-def source_page_exists(url: str, source_wiki: str) -> bool:
+def source_page_exists(url: str, source_wiki: str, session: Optional[requests.Session] = None) -> Optional[bool]:
         """
         Converts a branch URL into a source URL of the same page and checks if it exists there
+
+        Returns None if that can't be told, because the request failed or the status code was unexpected
         """
         try:
             parsed_url = parse.urlparse(url)
         except ValueError:
             error(f'Cannot parse URL "{url}"')
-            return False
+            return None
         # TODO: This will break if the source wiki does not support HTTPS
         parsed_url = parsed_url._replace(scheme='https')._replace(netloc=f"{source_wiki}.wikidot.com")
         original_url = parse.urlunparse(parsed_url)
         try:
-            head_result = requests.head(original_url, headers={'User-Agent': USER_AGENT})
+            head_result = (session or requests).head(original_url, headers={'User-Agent': USER_AGENT})
         except requests.RequestException as e:
             error(f'Request to {original_url} failed ({str(e)})')
-            return False
+            return None
         match head_result.status_code:
             case 200:
                 return True
@@ -38,7 +42,7 @@ def source_page_exists(url: str, source_wiki: str) -> bool:
                 return False
             case _:
                 warning(f'Got unusual status code ({head_result.status_code}) for URL {original_url}')
-                return False
+                return None
 
 def get_site_slug(url: str) -> str:
     parsed_url = parse.urlparse(url)
@@ -48,7 +52,7 @@ def get_site_slug(url: str) -> str:
 def snapshot_original(url: str, source_wiki_name: str = "scp-wiki",\
                        revision_id: int = 0, client: Optional[wikidot.Client] = None, fail_on_not_found: bool = True) -> Optional[PathLike | str]:
     """
-    Downloads a copy of a page's original on the source wiki, saves it to the temp directory and returns the path
+    Downloads a copy of a page's original on the source wiki, saves it to the snapshot store and returns the path of the blob
 
     revision_id is optional and only used for file name
     """
@@ -63,10 +67,7 @@ def snapshot_original(url: str, source_wiki_name: str = "scp-wiki",\
             info(f"Original page \"{page_name}\" not found on source wiki, skipping...")
         return None
     page_source = original_page.source
-    filename = page_name + '-' + str(revision_id) + '.txt'
-    file_path = path.join(getcwd(), 'temp', 'snapshots', source_wiki_name, filename)
-    with open(file_path, 'w', encoding='utf-8') as file:
-        file.write(page_source.wiki_text)
+    file_path = snapshot_store.save(source_wiki_name, page_name, int(revision_id), page_source.wiki_text)
     info(f"Snapshot of \"{page_name}\" saved as {file_path}")
     return file_path
 
@@ -81,40 +82,40 @@ def map_target_wiki_to_source() -> dict[str, str]:
         wiki_map[wiki['target_wiki']] = wiki['source_wiki']
     return wiki_map
 
-def snapshot_all():
-    translations = Article.select(Article.link, Article.name).where(Article.is_original == False).execute()
+# Batch name of the jobs queued by snapshot_all
+SNAPSHOT_ALL_BATCH = 'snapshot_all'
+
+def snapshot_all(queue) -> int:
+    """
+    Queues a snapshot of the original of every translation on the snapshot queue and returns how many were queued
+
+    The queue remembers every job, so translations that were already queued (or saved) aren't queued again
+    and an interrupted run just continues where it stopped
+    """
+    translations = Article.select(Article.link, Article.name).where(Article.is_original == False).tuples()
     wiki_map = map_target_wiki_to_source()
     # I'm not adding an entire library just to validate a URL bro
     url_regex = re.compile(r"^(http|https):\/\/[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}(/[a-zA-Z0-9\-._~:/?#[\]@!$&'()*+,;=]*)?$", re.IGNORECASE)
-    client = wikidot.Client()
-    for tr in translations:
-        link = str(tr.link)
-        name = str(tr.name)
-        target_wiki_name = parse.urlparse(link).netloc.split('.')[0]  
-        
-        # info(f"URL is {link}")
-
-        if not link or not url_regex.match(link) or not target_wiki_name:
-            info(f"Skipping {name}, invalid URL")
+    # Snapshots saved before the queue existed, read once per wiki from the store manifest and the old plain text directory
+    saved = {}
+    jobs = []
+    for link, name in translations:
+        if not link or not url_regex.match(link):
+            debug(f"Skipping {name}, invalid URL")
             continue
-        
-        source_wiki_name = wiki_map[target_wiki_name]
-
-        # We check if we haven't already backed this one up
-        if path.isfile(path.join(getcwd(), 'temp', 'snapshots', source_wiki_name, get_site_slug(link)+'-0.txt')): 
-            info(f"Skipping {name}, file exists")
+        target_wiki_name = parse.urlparse(link).netloc.split('.')[0]
+        source_wiki_name = wiki_map.get(target_wiki_name)
+        if not source_wiki_name:
+            debug(f"Skipping {name}, no source wiki for {target_wiki_name}")
             continue
-
-        # We check whether the page exists to not spam wikidot with unnecessary requests
-        # source_page_exists only sends a single HEAD request
-        #if not source_page_exists(link, source_wiki_name): 
-        #    info(f"Skipping {name} (source page not found)")
-        #    continue
-        try:
-            info(f"Making snapshot of \"{name}\"")
-            file_path = snapshot_original(link, source_wiki_name, client=client, fail_on_not_found=False)
-        except Exception as e:
-            warning(f"Skipping {name}, error while downloading snapshot ({str(e)})")
-        else:
-            info(f"Snapshot saved as {file_path}")
-
+        if source_wiki_name not in saved:
+            snapshot_dir = path.join(getcwd(), 'temp', 'snapshots', source_wiki_name)
+            legacy = {name.removesuffix('-0.txt') for name in listdir(snapshot_dir) if name.endswith('-0.txt')} if path.isdir(snapshot_dir) else set()
+            saved[source_wiki_name] = legacy | snapshot_store.saved_slugs(source_wiki_name, revision=0)
+        already_saved = get_site_slug(link) in saved[source_wiki_name]
+        jobs.append({'url': link, 'source_wiki': source_wiki_name, 'revision': 0,
+                     'status': SnapshotJobStatus.DONE if already_saved else SnapshotJobStatus.PENDING,
+                     'finished': datetime.now() if already_saved else None})
+    queued = queue.enqueue_many(jobs, batch=SNAPSHOT_ALL_BATCH)
+    info(f"Queued {queued} snapshots ({len(jobs) - queued} already queued)")
+    return queued
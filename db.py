@@ -1,10 +1,207 @@
 import datetime
+import re
+import time
+from dataclasses import dataclass, field
+from enum import IntEnum
+from functools import wraps
+import threading
+from threading import Lock
+from uuid import uuid4
+from urllib.parse import urlsplit
+from cachetools import LRUCache
 from peewee import *
-from logging import debug
+from playhouse.pool import PooledSqliteDatabase
+from playhouse.sqlite_ext import FTS5Model, SearchField, RowIDField
+from logging import debug, info, warning
+
+# Defaults for the "DATABASE" config key
+DEFAULT_DATABASE_CONFIG = {
+    "PATH": "data/scp.db",
+    "JOURNAL_MODE": "wal",          # Readers don't block writers and vice versa
+    "SYNCHRONOUS": "normal",        # Safe with WAL, only the last transactions can be lost on power failure
+    "BUSY_TIMEOUT": 5000,           # How long a writer waits for the lock (ms)
+    "MMAP_SIZE": 256*1024*1024,     # Bytes of the database file mapped into memory
+    "CACHE_SIZE": -64000,           # Page cache per connection, negative values are in KiB
+    "MAX_CONNECTIONS": None,        # Pooled connections, None means one for each thread that needs it
+    "STALE_TIMEOUT": 3600,          # Pooled connections older than this (s) get reopened
+}
+
+# Writes slower than this are logged
+SLOW_LOCK_WAIT = 1.0
+
+r_write_statement = re.compile(r"^\s*(INSERT|UPDATE|DELETE|REPLACE)\b", re.IGNORECASE)
+r_written_table = re.compile(r"^\s*(?:(?:INSERT|REPLACE)(?:\s+OR\s+\w+)?\s+INTO|UPDATE(?:\s+OR\s+\w+)?|DELETE\s+FROM)\s+[\"`\[]?(\w+)", re.IGNORECASE)
+
+# Writes to these tables invalidate everything cached from the database
+# Leaderboard is normally written by triggers, it's only here for rebuild_leaderboard
+VERSIONED_TABLES = ('Article', 'User', 'Leaderboard')
+
+@dataclass
+class LockStats:
+    """
+    Time spent by writers waiting for the database write lock
+    """
+    transactions: int = 0
+    total_wait: float = 0.0
+    max_wait: float = 0.0
+    failures: int = 0
+    mutex: Lock = field(default_factory=Lock, repr=False)
+
+    def record(self, wait: float) -> None:
+        with self.mutex:
+            self.transactions += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+    def record_failure(self) -> None:
+        with self.mutex:
+            self.failures += 1
 
-database = SqliteDatabase("data/scp.db")
+    @property
+    def average_wait(self) -> float:
+        return self.total_wait / self.transactions if self.transactions else 0.0
+
+@dataclass
+class DataVersion:
+    """
+    Counts committed writes to VERSIONED_TABLES, anything derived from them stays valid until the version changes
+    """
+    version: int = 0
+    tables: dict = field(default_factory=lambda: dict.fromkeys(VERSIONED_TABLES, 0))
+    # Time of the last committed write, or startup
+    changed: datetime.datetime = field(default_factory=datetime.datetime.now)
+    mutex: Lock = field(default_factory=Lock, repr=False)
+
+    def bump(self, tables: set) -> None:
+        with self.mutex:
+            for table in tables:
+                self.tables[table] += 1
+            self.version += 1
+            self.changed = datetime.datetime.now()
+
+    def get(self, table: str | None = None) -> int:
+        return self.tables[table] if table else self.version
+
+class TimedSqliteDatabase(PooledSqliteDatabase):
+    """
+    A connection pool which takes the write lock at the start of every write transaction
+
+    Doing that with BEGIN IMMEDIATE means the time a writer spends blocked by other writers
+    is exactly the time it takes to begin the transaction, which gets recorded in lock_stats
+
+    It also tracks which of the VERSIONED_TABLES each transaction writes to and bumps write_version when it commits
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.lock_stats = LockStats()
+        self.write_version = DataVersion()
+        self._written = threading.local()
+        self._versioned = {table.lower(): table for table in VERSIONED_TABLES}
+        super().__init__(*args, **kwargs)
+
+    def _pending_tables(self) -> set:
+        if not hasattr(self._written, 'tables'):
+            self._written.tables = set()
+        return self._written.tables
+
+    def commit(self):
+        result = super().commit()
+        pending = self._pending_tables()
+        if pending:
+            self.write_version.bump(pending)
+            pending.clear()
+        return result
+
+    def rollback(self):
+        self._pending_tables().clear()
+        return super().rollback()
+
+    def begin(self, lock_type=None):
+        start = time.perf_counter()
+        try:
+            super().begin(lock_type or 'IMMEDIATE')
+        except OperationalError:
+            # Busy timeout ran out
+            self.lock_stats.record_failure()
+            raise
+        wait = time.perf_counter() - start
+        self.lock_stats.record(wait)
+        if wait > SLOW_LOCK_WAIT:
+            warning(f"Waited {wait:.2f}s for the database write lock")
+
+    def execute_sql(self, sql, params=None, commit=None):
+        if (match := r_written_table.match(sql)) and match.group(1).lower() in self._versioned:
+            self._pending_tables().add(self._versioned[match.group(1).lower()])
+        # Writes outside of a transaction would take the lock implicitly, wrap them so the wait is measured
+        if not self.in_transaction() and r_write_statement.match(sql):
+            with self.atomic():
+                return super().execute_sql(sql, params)
+        return super().execute_sql(sql, params)
+
+def database_config(config: dict) -> dict:
+    return DEFAULT_DATABASE_CONFIG | config.get('DATABASE', {})
+
+def database_options(db_config: dict) -> dict:
+    return {
+        'pragmas': {
+            'journal_mode': db_config['JOURNAL_MODE'],
+            'synchronous': db_config['SYNCHRONOUS'],
+            'busy_timeout': db_config['BUSY_TIMEOUT'],
+            'mmap_size': db_config['MMAP_SIZE'],
+            'cache_size': db_config['CACHE_SIZE'],
+        },
+        # Pooled connections get handed to whichever thread needs one next
+        'check_same_thread': False,
+        'max_connections': db_config['MAX_CONNECTIONS'],
+        'stale_timeout': db_config['STALE_TIMEOUT'],
+    }
+
+database = TimedSqliteDatabase(DEFAULT_DATABASE_CONFIG['PATH'], **database_options(DEFAULT_DATABASE_CONFIG))
 
 PAGE_ITEMS = 15
+SEARCH_LIMIT = 100
+
+def data_version(table: str | None = None) -> int:
+    """
+    Changes after every committed write to one of the VERSIONED_TABLES (or just to the given table)
+    """
+    return database.write_version.get(table)
+
+def memoize_by_version(table: str | None = None):
+    """
+    Caches the result of a function without arguments until the data version changes
+    """
+    def decorator(func):
+        memo = {}
+        @wraps(func)
+        def wrapper():
+            # Read the version first, a write committed while func runs can only make the value newer
+            version = data_version(table)
+            if memo.get('version') != version:
+                memo['value'], memo['version'] = func(), version
+            return memo['value']
+        return wrapper
+    return decorator
+
+def init_app(app) -> None:
+    """
+    Applies the database config and opens a pooled connection for the duration of each request
+    """
+    db_config = database_config(app.config)
+    if not database.is_closed():
+        database.close()
+    database.init(db_config['PATH'], **database_options(db_config))
+    info(f"Using database {db_config['PATH']} (journal mode {db_config['JOURNAL_MODE']})")
+
+    @app.before_request
+    def open_connection():
+        database.connect(reuse_if_open=True)
+
+    # Closing only returns the connection to the pool
+    @app.teardown_request
+    def close_connection(_):
+        if not database.is_closed():
+            database.close()
 
 # Creates the views that peewee doesn't support by executing raw SQL
 def create_views(database: SqliteDatabase):
@@ -12,37 +209,86 @@ def create_views(database: SqliteDatabase):
 
     # TODO: This is so fucking horrible like what am I even looking at whz did I write this
 
-    database.execute_sql("CREATE VIEW IF NOT EXISTS Frontpage AS\
-    SELECT User.id AS id, User.nickname AS nickname, User.discord AS discord, User.wikidot AS wikidot, User.display_name as display, \
-        SUM(CASE WHEN Article.is_original=FALSE THEN 1 ELSE 0 END) AS translation_count, \
-        (SUM(CASE WHEN Article.is_original=FALSE THEN Article.words ELSE 0 END)/1000.0)+TOTAL(Article.bonus) AS points,\
-        (SELECT COUNT(article_id) FROM Correction WHERE Corrector=User.id) AS correction_count,\
-        SUM(CASE WHEN Article.is_original=TRUE THEN 1 ELSE 0 END) AS original_count\
-            FROM user\
-                LEFT JOIN Article \
-                    ON User.id = Article.idauthor\
-            GROUP BY User.id;")
-    
-    database.execute_sql("CREATE VIEW IF NOT EXISTS Series AS \
-        SELECT (SUBSTR(name, 5)/1000)+1 AS series, COUNT(id) AS articles, SUM(words) AS words \
-            FROM Article \
-            WHERE (name \
-                LIKE 'SCP-___' OR name LIKE 'SCP-____') AND is_original=FALSE \
-            GROUP BY SERIES\
-        UNION\
-        SELECT 999 AS series, COUNT(id) AS articles, SUM(words) AS words\
-            FROM Article\
-            WHERE name\
-                NOT LIKE 'SCP-___' AND name NOT LIKE 'SCP-____' AND is_original=FALSE;")
-    
-    database.execute_sql("CREATE VIEW IF NOT EXISTS Statistics AS\
-        SELECT SUM(t.words) AS total_words, COUNT(t.id) AS total_articles, (SELECT COUNT(id) FROM user) AS total_users\
-            FROM Article AS t WHERE t.is_original=FALSE;")
-    
+    # The leaderboard used to be computed by the Frontpage view, it's a real table maintained by triggers now
+    # The same goes for the Series and Statistics views, which are dropped by migration 4
+    database.execute_sql("DROP VIEW IF EXISTS Frontpage;")
+
     database.execute_sql("CREATE VIEW IF NOT EXISTS Correction AS\
         SELECT id as article_id, idauthor AS author, idcorrector AS corrector, corrected AS timestamp, words, name\
             FROM Article WHERE idcorrector IS NOT NULL;")
 
+# Drops every view that has ever existed so create_views can recreate the current ones
+# Has to be done before migrations, SQLite can't rename a table while a view refers to it
+def drop_views(database: SqliteDatabase):
+    debug("Dropping database views")
+    for view in ['Frontpage', 'Series', 'Statistics', 'Correction']:
+        database.execute_sql(f"DROP VIEW IF EXISTS {view};")
+
+# Keeps the Leaderboard table in sync with Article and User
+# Points are recomputed from the integer word and bonus sums on every change so they never drift
+def create_triggers(database: SqliteDatabase):
+    debug("Creating database triggers")
+
+    database.execute_sql("CREATE TRIGGER IF NOT EXISTS leaderboard_user_insert AFTER INSERT ON User\
+    BEGIN\
+        INSERT OR IGNORE INTO Leaderboard (id, translation_count, correction_count, original_count, words, bonus, points, version)\
+            VALUES (NEW.id, 0, 0, 0, 0, 0, 0, 0);\
+    END;")
+
+    database.execute_sql("CREATE TRIGGER IF NOT EXISTS leaderboard_user_delete AFTER DELETE ON User\
+    BEGIN\
+        DELETE FROM Leaderboard WHERE id = OLD.id;\
+    END;")
+
+    add_article = "UPDATE Leaderboard SET\
+            translation_count = translation_count + (NEW.is_original = FALSE),\
+            original_count = original_count + (NEW.is_original = TRUE),\
+            words = words + (CASE WHEN NEW.is_original = FALSE THEN NEW.words ELSE 0 END),\
+            bonus = bonus + IFNULL(NEW.bonus, 0),\
+            points = (words + (CASE WHEN NEW.is_original = FALSE THEN NEW.words ELSE 0 END))/1000.0 + bonus + IFNULL(NEW.bonus, 0)\
+        WHERE id = NEW.idauthor;\
+        UPDATE Leaderboard SET correction_count = correction_count + 1 WHERE id = NEW.idcorrector;"
+
+    remove_article = "UPDATE Leaderboard SET\
+            translation_count = translation_count - (OLD.is_original = FALSE),\
+            original_count = original_count - (OLD.is_original = TRUE),\
+            words = words - (CASE WHEN OLD.is_original = FALSE THEN OLD.words ELSE 0 END),\
+            bonus = bonus - IFNULL(OLD.bonus, 0),\
+            points = (words - (CASE WHEN OLD.is_original = FALSE THEN OLD.words ELSE 0 END))/1000.0 + bonus - IFNULL(OLD.bonus, 0)\
+        WHERE id = OLD.idauthor;\
+        UPDATE Leaderboard SET correction_count = correction_count - 1 WHERE id = OLD.idcorrector;"
+
+    database.execute_sql(f"CREATE TRIGGER IF NOT EXISTS leaderboard_article_insert AFTER INSERT ON Article\
+    BEGIN {add_article} END;")
+
+    database.execute_sql(f"CREATE TRIGGER IF NOT EXISTS leaderboard_article_delete AFTER DELETE ON Article\
+    BEGIN {remove_article} END;")
+
+    database.execute_sql(f"CREATE TRIGGER IF NOT EXISTS leaderboard_article_update\
+    AFTER UPDATE OF idauthor, idcorrector, is_original, words, bonus ON Article\
+    BEGIN {remove_article} {add_article} END;")
+
+    # Leaderboard.version changes whenever anything shown on the user's profile or embed does, it's used for ETags
+    database.execute_sql("CREATE TRIGGER IF NOT EXISTS user_version_user_update AFTER UPDATE ON User\
+    BEGIN\
+        UPDATE Leaderboard SET version = version + 1 WHERE id = NEW.id;\
+    END;")
+
+    database.execute_sql("CREATE TRIGGER IF NOT EXISTS user_version_article_insert AFTER INSERT ON Article\
+    BEGIN\
+        UPDATE Leaderboard SET version = version + 1 WHERE id IN (NEW.idauthor, NEW.idcorrector);\
+    END;")
+
+    database.execute_sql("CREATE TRIGGER IF NOT EXISTS user_version_article_delete AFTER DELETE ON Article\
+    BEGIN\
+        UPDATE Leaderboard SET version = version + 1 WHERE id IN (OLD.idauthor, OLD.idcorrector);\
+    END;")
+
+    database.execute_sql("CREATE TRIGGER IF NOT EXISTS user_version_article_update AFTER UPDATE ON Article\
+    BEGIN\
+        UPDATE Leaderboard SET version = version + 1 WHERE id IN (OLD.idauthor, OLD.idcorrector, NEW.idauthor, NEW.idcorrector);\
+    END;")
+
 class BaseModel(Model):
     class Meta:
         database = database
@@ -89,6 +335,37 @@ class User(BaseModel):
     class Meta:
         table_name = 'User'
 
+OTHER_SERIES = 999
+
+r_scp_number = re.compile(r"^SCP-(\d{3,4})$", re.IGNORECASE)
+
+def parse_series(name: str) -> tuple[int | None, bool]:
+    """
+    Returns the series number of an SCP article name (SCP-173 is series 1, SCP-2000 is series 3)
+    and whether the name is an SCP at all
+    """
+    match = r_scp_number.match(name.strip())
+    if not match:
+        return None, False
+    return int(match.group(1))//1000+1, True
+
+r_repeated_slash = re.compile(r"/{2,}")
+
+def canonical_link(link: str | None) -> str | None:
+    """
+    Reduces a page URL to the part that identifies the page, eg. "HTTPS://www.SCP-CS.wikidot.com/scp-173/" becomes "scp-cs.wikidot.com/scp-173"
+
+    The scheme, www., query, fragment and trailing slashes are dropped and everything is lowercased, Wikidot page names are case-insensitive
+    """
+    if not link or not link.strip():
+        return None
+    link = link.strip()
+    # Without a scheme urlsplit takes the host for a part of the path
+    parts = urlsplit(link if '//' in link else '//' + link)
+    host = (parts.hostname or '').removeprefix('www.')
+    path = r_repeated_slash.sub('/', parts.path).rstrip('/').lower()
+    return f"{host}{path}" or None
+
 class Article(BaseModel):
     id = AutoField()
     added = DateTimeField(default=datetime.datetime.now)
@@ -98,8 +375,31 @@ class Article(BaseModel):
     corrector = ForeignKeyField(backref='corrections', column_name='idcorrector', field='id', model=User, null=True)
     is_original = BooleanField(default=False)
     link = TextField(null=True)
+    # canonical_link of the link, set by save when the link changes
+    # Unique, but the index is only created by migration 6, create_tables would add it before the column exists
+    # NULL for articles that migration 6 found to duplicate an older article's link
+    link_key = TextField(null=True)
     name = TextField()
     words = IntegerField()
+    series = IntegerField(null=True)
+    is_scp = BooleanField(default=False)
+
+    def save(self, *args, **kwargs):
+        self.series, self.is_scp = parse_series(self.name)
+        if self.id is None or kwargs.get('force_insert') or self.link_changed():
+            self.link_key = canonical_link(self.link)
+        return super().save(*args, **kwargs)
+
+    def link_changed(self) -> bool:
+        """
+        Whether the canonical form of the link differs from the one saved in the database
+
+        Forms assign the link even when it stays the same, so the saved one has to be read
+        """
+        if 'link' not in {f.name for f in self.dirty_fields}:
+            return False
+        saved = Article.select(Article.link).where(Article.id == self.id).scalar()
+        return canonical_link(saved) != canonical_link(self.link)
 
     def to_dict(self):
         return {
@@ -183,21 +483,105 @@ class WikiCommaConfig(BaseModel):
     ratelimit_refill = IntegerField(null=True)
     blacklist = TextField(null=True)
 
-class Series(ViewModel):
-    series = IntegerField()
-    articles = IntegerField()
-    words = IntegerField()
+# Translation count and word count for each SCP series, articles that aren't SCPs are counted under OTHER_SERIES
+# Kept up to date by triggers created in migration 4
+class SeriesStats(BaseModel):
+    series = IntegerField(primary_key=True)
+    articles = IntegerField(default=0)
+    words = IntegerField(default=0)
+
+    class Meta:
+        table_name = 'SeriesStats'
+
+class RssUpdateStatus(IntEnum):
+    PENDING = 0
+    DONE = 1        # Added as a new article or assigned to one
+    IGNORED = 2
+
+# Changes from the RSS feeds waiting for someone to add them, shared by every server process
+class RssUpdate(BaseModel):
+    id = AutoField()
+    # GUID of the feed entry, the same entry is never queued twice
+    guid = TextField(unique=True)
+    # Identifies the update in links and forms
+    uuid = UUIDField(unique=True, default=uuid4)
+    feed = TextField()
+    update_type = IntegerField()
+    status = IntegerField(default=RssUpdateStatus.PENDING)
+    title = TextField()
+    link = TextField()
+    author = ForeignKeyField(User, field='id', column_name='idauthor', backref='rss_updates')
+    # When the change happened on the wiki
+    timestamp = DateTimeField()
+    created = DateTimeField(default=datetime.datetime.now)
+    resolved = DateTimeField(null=True)
+
+    class Meta:
+        table_name = 'RssUpdate'
+        indexes = (
+            # Pending updates of one type or from one feed, newest first
+            (('status', 'update_type', 'timestamp'), False),
+            (('status', 'feed', 'timestamp'), False),
+        )
+
+# GUIDs of every RSS feed entry that has been processed, rows not seen in a feed for a while get swept
+class RssSeenGuid(BaseModel):
+    guid = TextField(primary_key=True)
+    # Last time the entry was in a feed
+    seen = DateTimeField(default=datetime.datetime.now, index=True)
 
     class Meta:
-        table_name = 'Series'
+        table_name = 'RssSeenGuid'
+
+class SnapshotJobStatus(IntEnum):
+    PENDING = 0
+    RUNNING = 1
+    DONE = 2
+    SKIPPED = 3     # The original page doesn't exist
+    FAILED = 4      # Still failing after the last retry
+
+# Snapshots of original pages waiting to be downloaded, processed by the SnapshotQueue workers
+class SnapshotJob(BaseModel):
+    id = AutoField()
+    url = TextField()
+    source_wiki = TextField()
+    revision = IntegerField(default=0)
+    status = IntegerField(default=SnapshotJobStatus.PENDING)
+    attempts = IntegerField(default=0)
+    # A failed job isn't picked up again before this
+    next_attempt = DateTimeField(default=datetime.datetime.now)
+    created = DateTimeField(default=datetime.datetime.now)
+    started = DateTimeField(null=True)
+    finished = DateTimeField(null=True)
+    error = TextField(null=True)
+    path = TextField(null=True)
+    # Jobs queued together, eg. by snapshot_all, so their progress can be followed (indexed in migration 7)
+    batch = TextField(null=True)
 
-class Statistics(ViewModel):
-    total_words = IntegerField()
-    total_articles = IntegerField()
-    total_users = IntegerField()
+    class Meta:
+        table_name = 'SnapshotJob'
+        indexes = (
+            # The same revision is only ever queued once
+            (('url', 'source_wiki', 'revision'), True),
+            (('status', 'next_attempt'), False),
+        )
+
+# Manifest of the page snapshot store, each saved revision points to a compressed blob named by the hash of its text
+class PageSnapshot(BaseModel):
+    id = AutoField()
+    source_wiki = TextField()
+    slug = TextField()
+    revision = IntegerField(default=0)
+    blob = CharField(64, index=True)
+    # Length of the uncompressed text in bytes
+    size = IntegerField()
+    created = DateTimeField(default=datetime.datetime.now)
 
     class Meta:
-        table_name = 'Statistics'
+        table_name = 'PageSnapshot'
+        indexes = (
+            (('source_wiki', 'slug', 'revision'), True),
+        )
 
 class Correction(ViewModel):
     article = ForeignKeyField(Article, field='id', column_name='article_id', backref='correction')
@@ -216,31 +600,315 @@ class Correction(ViewModel):
             'words': self.words
         }
 
-class Frontpage(ViewModel):
-    user = ForeignKeyField(User, field='id', column_name='id', backref='stats')
-    translation_count = IntegerField()
-    points = FloatField()
-    correction_count = IntegerField()
-    original_count = IntegerField()
+class Leaderboard(BaseModel):
+    user = ForeignKeyField(User, field='id', column_name='id', backref='stats', primary_key=True)
+    translation_count = IntegerField(default=0)
+    correction_count = IntegerField(default=0)
+    original_count = IntegerField(default=0)
+    words = IntegerField(default=0)
+    bonus = IntegerField(default=0)
+    points = FloatField(default=0)
+    version = IntegerField(default=0)
+
+    class Meta:
+        table_name = 'Leaderboard'
+        indexes = (
+            (('points', 'user'), False),
+            (('translation_count', 'user'), False),
+            (('correction_count', 'user'), False),
+            (('original_count', 'user'), False),
+        )
+
+class SchemaVersion(BaseModel):
+    version = IntegerField(primary_key=True)
+    name = TextField()
+    applied = DateTimeField(default=datetime.datetime.now)
 
-models = [User, Article, Backup, Note, UserType, UserHasType, Backup, Wiki, WikiCommaConfig, BackupHasWiki]
+    class Meta:
+        table_name = 'SchemaVersion'
+
+# Full-text index over article titles and URL slugs, the rowid is the article ID
+# Filled in by triggers created in migration 2, not a part of models since it's created there as well
+class ArticleSearch(FTS5Model):
+    rowid = RowIDField()
+    name = SearchField()
+    slug = SearchField()
+
+    class Meta:
+        database = database
+        table_name = 'ArticleSearch'
+        # Diacritics are ignored so "pribeh" finds "Příběh", prefix indexes make short prefix queries cheap
+        options = {'tokenize': 'unicode61 remove_diacritics 2', 'prefix': '2 3'}
+
+# Substring index over the names users can be searched by, the rowid is the user ID
+# Filled in by triggers created in migration 3
+class UserSearch(FTS5Model):
+    rowid = RowIDField()
+    nickname = SearchField()
+    display_name = SearchField()
+    wikidot = SearchField()
+    discord = SearchField()
+
+    class Meta:
+        database = database
+        table_name = 'UserSearch'
+        # Trigrams match any substring of at least three characters, case-insensitive
+        options = {'tokenize': 'trigram'}
+
+models = [User, Article, Backup, Note, UserType, UserHasType, Backup, Wiki, WikiCommaConfig, BackupHasWiki, Leaderboard, SchemaVersion, SeriesStats, RssUpdate, RssSeenGuid, SnapshotJob, PageSnapshot]
+
+def get_series_stats() -> list:
+    return list(SeriesStats.select().where(SeriesStats.articles > 0).order_by(SeriesStats.series))
+
+def get_global_stats(series_stats: list) -> dict:
+    """
+    Sums up the per-series stats, there's only a handful of rows so this is cheap
+    """
+    return {
+        'total_words': sum(s.words for s in series_stats),
+        'total_articles': sum(s.articles for s in series_stats),
+        'total_users': User.select().count()
+    }
 
 def last_update() -> datetime.datetime:
     return Article.select(fn.MAX(Article.added)).scalar() or datetime.datetime(year=1990, month=1, day=1)
 
-def get_frontpage(sort: str, page: int):
-    entries = Frontpage.select().join(User).limit(PAGE_ITEMS).offset(PAGE_ITEMS*page)
-    match sort:
-        case 'az':
-            result = entries.order_by(User.nickname.collate("NOCASE").asc()).prefetch(User)
-        case 'points':
-            result = entries.order_by(Frontpage.points.desc()).prefetch(User)
-        case 'count':
-            result = entries.order_by(Frontpage.translation_count.desc()).prefetch(User)
-        case 'corrections':
-            result = entries.order_by(Frontpage.correction_count.desc()).prefetch(User)
-        case 'originals':
-            result = entries.order_by(Frontpage.original_count.desc()).prefetch(User)
-        case _:
-            result = entries.order_by(Frontpage.points.desc()).prefetch(User)
-    return result
+@memoize_by_version()
+def last_modified() -> datetime.datetime:
+    """
+    Time of the last change to the data, for Last-Modified headers
+
+    last_update only covers new articles, edits are covered by the time of the last write
+    """
+    return max(last_update(), database.write_version.changed)
+
+def data_state() -> str:
+    """
+    Fingerprint of the data pages are built from, read from the database so it survives restarts and is the same in every process
+
+    Every write to an article or a user bumps someone's Leaderboard.version, added and deleted users change the count and the highest ID
+    """
+    versions, users, last_user = Leaderboard.select(fn.TOTAL(Leaderboard.version), fn.COUNT(Leaderboard.user), fn.MAX(Leaderboard.user)).tuples().get()
+    return f"{int(versions)}.{users}.{last_user or 0}"
+
+def user_version(uid: int) -> int | None:
+    """
+    Leaderboard.version of a single user, None if there's no such user
+
+    Read from the database every time (it's a primary key lookup), so writes from other processes count as well
+    """
+    row = Leaderboard.select(Leaderboard.version).where(Leaderboard.user == uid).tuples().first()
+    return row[0] if row else None
+
+def find_article_by_link(link: str | None, exclude: int | None = None) -> Article | None:
+    """
+    Finds the article with the same canonical link, optionally other than the given article
+    """
+    key = canonical_link(link)
+    if key is None:
+        return None
+    query = Article.select().where(Article.link_key == key)
+    if exclude is not None:
+        query = query.where(Article.id != exclude)
+    return query.first()
+
+r_slug_separator = re.compile(r"[^a-z0-9]+")
+
+def wikidot_slug(name: str) -> str:
+    """
+    Turns a Wikidot username into the form used in its profile URL, eg. "John_Doe 2" becomes "john-doe-2"
+    """
+    return r_slug_separator.sub('-', name.lower()).strip('-')
+
+@memoize_by_version('User')
+def wikidot_slug_index() -> dict[str, int]:
+    """
+    Maps the URL form of each user's Wikidot username to their ID, rebuilt only after users change
+    """
+    index = {}
+    for uid, wikidot in User.select(User.id, User.wikidot).tuples():
+        slug = wikidot_slug(wikidot)
+        if not slug:
+            continue
+        if slug in index:
+            warning(f"Wikidot usernames of users {index[slug]} and {uid} look the same in URLs")
+            continue
+        index[slug] = uid
+    return index
+
+def find_user_by_wikidot_slug(slug: str) -> User | None:
+    uid = wikidot_slug_index().get(wikidot_slug(slug))
+    return User.get_or_none(User.id == uid) if uid is not None else None
+
+# Leaderboard rows of recently viewed users, with the user version they were read at
+USER_STATS_CACHE_SIZE = 512
+user_stats_cache = LRUCache(USER_STATS_CACHE_SIZE)
+user_stats_lock = Lock()
+
+def get_user_stats(uid: int) -> Leaderboard | None:
+    """
+    Points and article counts of a single user
+
+    The row is cached until the user's version changes, which only happens when they or their articles do
+    """
+    # From the database, not a memo, another process might have changed the user
+    version = user_version(uid)
+    if version is None:
+        return None
+    with user_stats_lock:
+        cached = user_stats_cache.get(uid)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    stats = Leaderboard.get_or_none(Leaderboard.user == uid)
+    with user_stats_lock:
+        user_stats_cache[uid] = (version, stats)
+    return stats
+
+def rebuild_leaderboard() -> int:
+    """
+    Recomputes the whole Leaderboard table from scratch, returns the number of rows written
+
+    The triggers keep the table up to date, this is only needed after the table is first created
+    or if someone edits the database by hand with the triggers missing
+    """
+    with database.atomic():
+        # Versions must keep growing, otherwise clients could get a 304 for an ETag from before the rebuild
+        version = (Leaderboard.select(fn.MAX(Leaderboard.version)).scalar() or 0) + 1
+        Leaderboard.delete().execute()
+        database.execute_sql("INSERT INTO Leaderboard (id, translation_count, correction_count, original_count, words, bonus, points, version)\
+            SELECT User.id,\
+                TOTAL(Article.is_original=FALSE),\
+                (SELECT COUNT(c.id) FROM Article AS c WHERE c.idcorrector=User.id),\
+                TOTAL(Article.is_original=TRUE),\
+                TOTAL(CASE WHEN Article.is_original=FALSE THEN Article.words ELSE 0 END),\
+                TOTAL(Article.bonus),\
+                (TOTAL(CASE WHEN Article.is_original=FALSE THEN Article.words ELSE 0 END)/1000.0)+TOTAL(Article.bonus),\
+                ?\
+                FROM User\
+                    LEFT JOIN Article\
+                        ON User.id = Article.idauthor\
+                GROUP BY User.id;", (version,))
+    return Leaderboard.select().count()
+
+# Sort key, tiebreaker and direction for each leaderboard ordering
+# The tiebreaker has to come from the same table as the key, otherwise SQLite can't use the index for ordering
+FRONTPAGE_SORTS = {
+    'az': (User.nickname.collate("NOCASE"), User.id, False),
+    'points': (Leaderboard.points, Leaderboard.user, True),
+    'count': (Leaderboard.translation_count, Leaderboard.user, True),
+    'corrections': (Leaderboard.correction_count, Leaderboard.user, True),
+    'originals': (Leaderboard.original_count, Leaderboard.user, True),
+}
+
+def keyset_page(query, key, row_id, descending: bool, after: tuple | None = None):
+    """
+    Orders a query by (key, row_id) and starts it right after the given (key, row_id) cursor
+
+    One extra row is fetched so split_page can tell whether there's a next page
+    The sort key and ID are selected as sort_key and sort_id to build the next cursor from
+    """
+    query = query.select_extend(key.alias('sort_key'), row_id.alias('sort_id'))
+    if after is not None:
+        position = Tuple(key, row_id)
+        query = query.where(position < Tuple(*after) if descending else position > Tuple(*after))
+    if descending:
+        return query.order_by(key.desc(), row_id.desc()).limit(PAGE_ITEMS+1)
+    return query.order_by(key.asc(), row_id.asc()).limit(PAGE_ITEMS+1)
+
+def selected_value(row, name: str):
+    if isinstance(row, dict):
+        return row[name]
+    # Peewee puts aliased columns of a joined table on the joined model instance
+    if hasattr(row, name):
+        return getattr(row, name)
+    for related in row.__rel__.values():
+        if hasattr(related, name):
+            return getattr(related, name)
+    raise AttributeError(f"{name} was not selected")
+
+def split_page(rows) -> tuple[list, tuple | None]:
+    """
+    Splits the result of a keyset_page query into the page itself and the (key, id) cursor of the next page
+    """
+    rows = list(rows)
+    if len(rows) <= PAGE_ITEMS:
+        return rows, None
+    last = rows[PAGE_ITEMS-1]
+    return rows[:PAGE_ITEMS], (selected_value(last, 'sort_key'), selected_value(last, 'sort_id'))
+
+def frontpage_query(sort: str, after: tuple | None = None):
+    key, row_id, descending = FRONTPAGE_SORTS.get(sort, FRONTPAGE_SORTS['points'])
+    entries = Leaderboard.select(Leaderboard, User).join(User)
+    return keyset_page(entries, key, row_id, descending, after)
+
+def get_frontpage(sort: str, page: int) -> tuple[list, tuple | None]:
+    """
+    Returns a page of the leaderboard by page number and the cursor of the page after it
+    """
+    return split_page(frontpage_query(sort).offset(PAGE_ITEMS*page))
+
+def get_frontpage_after(sort: str, after: tuple | None) -> tuple[list, tuple | None]:
+    """
+    Returns the page of the leaderboard following the given cursor and the cursor of the page after it
+    """
+    return split_page(frontpage_query(sort, after))
+
+def rss_updates_query(update_type: int | None = None, feed: str | None = None, after: tuple | None = None):
+    updates = RssUpdate.select(RssUpdate, User).join(User).where(RssUpdate.status == RssUpdateStatus.PENDING)
+    if update_type is not None:
+        updates = updates.where(RssUpdate.update_type == update_type)
+    if feed:
+        updates = updates.where(RssUpdate.feed == feed)
+    return keyset_page(updates, RssUpdate.timestamp, RssUpdate.id, True, after)
+
+def get_rss_updates(update_type: int | None = None, feed: str | None = None, after: tuple | None = None) -> tuple[list, tuple | None]:
+    """
+    Returns a page of pending RSS updates, newest first, and the cursor of the page after it
+    """
+    return split_page(rss_updates_query(update_type, feed, after))
+
+r_search_token = re.compile(r"\w+", re.UNICODE)
+
+def search_match_expression(query: str) -> str | None:
+    """
+    Turns a search box query into an FTS5 expression matching every word as a prefix
+    """
+    tokens = r_search_token.findall(query.lower())
+    if not tokens:
+        return None
+    # Quoting the tokens keeps FTS5 operators (AND, NEAR, ...) in the query from being interpreted
+    return ' '.join(f'"{token}"*' for token in tokens)
+
+def search_articles(query: str, author: int | None = None, limit: int = SEARCH_LIMIT):
+    """
+    Finds articles whose title or URL slug contains words starting with the words in query, best matches first
+    """
+    expression = search_match_expression(query)
+    if expression is None:
+        return Article.select().where(False)
+    # Title matches count double
+    rank = ArticleSearch.bm25(2.0, 1.0)
+    results = Article.select().join(ArticleSearch, on=(ArticleSearch.rowid == Article.id)).where(ArticleSearch.match(expression))
+    if author is not None:
+        results = results.where(Article.author == author)
+    return results.order_by(rank).limit(limit)
+
+def search_users(query: str, limit: int = SEARCH_LIMIT):
+    """
+    Finds users by a part of their nickname, display name, Wikidot username or Discord ID, best matches first
+
+    Returns Leaderboard rows joined with their users, so the stats come along for free
+    """
+    entries = Leaderboard.select(Leaderboard, User).join(User)
+    # Trigrams need at least three characters, the user table is small enough to just scan for shorter queries
+    if len(query) < 3:
+        param = f'%{query}%'
+        return entries.where(User.nickname ** param |
+                            User.wikidot ** param |
+                            User.display_name ** param |
+                            User.discord ** param).order_by(Leaderboard.points.desc()).limit(limit)
+    # Searching for the whole query as a phrase matches it as a substring
+    expression = '"' + query.replace('"', '""') + '"'
+    # Nicknames count the most, Discord IDs the least
+    rank = UserSearch.bm25(3.0, 2.0, 2.0, 1.0)
+    return entries.join(UserSearch, on=(UserSearch.rowid == User.id)).where(UserSearch.match(expression)).order_by(rank).limit(limit)
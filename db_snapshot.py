@@ -0,0 +1,128 @@
+"""
+Consistent copies of the live database
+
+The copy is made with SQLite's online backup API a few pages at a time, so writers are only held up
+for the duration of one step. The copy is then compressed with zstd in chunks, never read into memory whole.
+"""
+
+import os
+import sqlite3
+import tempfile
+from datetime import datetime
+from logging import info, warning
+from typing import Iterator
+
+from pyzstd import ZstdCompressor
+
+from db import database
+from exports import CHUNK_SIZE, ExportCompression, compress_chunks
+
+# Defaults for the "DATABASE_SNAPSHOT" config key
+DEFAULT_SNAPSHOT_CONFIG = {
+    "ENABLE": True,
+    "PATH": "data/snapshots",       # Where scheduled snapshots are kept
+    "INTERVAL": 24,                 # Hours between scheduled snapshots
+    "RETENTION": 7,                 # Number of snapshots kept, older ones get deleted
+    "PAGES": 256,                   # Database pages copied per backup step
+    "SLEEP": 0.05,                  # Pause between steps (s), writers can take the lock in the meantime
+    "INCLUDE_IN_BACKUP": True,      # Add a fresh snapshot to the WikiComma backup archive
+}
+
+SNAPSHOT_PREFIX = "scp_"
+SNAPSHOT_EXTENSION = ".db.zst"
+
+def snapshot_config(config: dict) -> dict:
+    return DEFAULT_SNAPSHOT_CONFIG | config.get('DATABASE_SNAPSHOT', {})
+
+def copy_database(destination: str, pages: int = DEFAULT_SNAPSHOT_CONFIG['PAGES'], sleep: float = DEFAULT_SNAPSHOT_CONFIG['SLEEP']) -> None:
+    """
+    Copies the database to a file with the online backup API
+
+    A write from another connection between two steps makes SQLite restart the copy,
+    so the result is always a single consistent state of the database
+    """
+    # A separate connection, the pooled ones belong to requests and scheduled jobs
+    source = sqlite3.connect(database.database)
+    target = sqlite3.connect(destination)
+    try:
+        with target:
+            source.backup(target, pages=pages, sleep=sleep)
+    finally:
+        target.close()
+        source.close()
+
+def file_chunks(path: str) -> Iterator[bytes]:
+    with open(path, 'rb') as file:
+        while chunk := file.read(CHUNK_SIZE):
+            yield chunk
+
+def compress_file(source: str, destination: str) -> None:
+    compressor = ZstdCompressor()
+    with open(destination, 'wb') as output:
+        for chunk in file_chunks(source):
+            output.write(compressor.compress(chunk))
+        output.write(compressor.flush())
+
+def snapshot_filename(date: datetime) -> str:
+    return f"{SNAPSHOT_PREFIX}{date.strftime('%Y-%m-%d_%H-%M-%S')}{SNAPSHOT_EXTENSION}"
+
+def list_snapshots(directory: str) -> list[str]:
+    """
+    Paths of the snapshots in a directory, oldest first
+    """
+    if not os.path.isdir(directory):
+        return []
+    # The timestamp in the name sorts the same as the date
+    names = sorted(n for n in os.listdir(directory) if n.startswith(SNAPSHOT_PREFIX) and n.endswith(SNAPSHOT_EXTENSION))
+    return [os.path.join(directory, n) for n in names]
+
+def prune_snapshots(directory: str, keep: int) -> int:
+    """
+    Deletes all but the newest few snapshots, returns how many were deleted
+    """
+    snapshots = list_snapshots(directory)
+    stale = snapshots[:-keep] if keep > 0 else snapshots
+    for path in stale:
+        try:
+            os.remove(path)
+        except OSError as e:
+            warning(f"Couldn't delete old database snapshot {path} ({str(e)})")
+    return len(stale)
+
+def create_snapshot(config: dict) -> str:
+    """
+    Saves a compressed snapshot of the database to the snapshot directory, deletes the ones over the retention limit
+    and returns the path of the new one
+    """
+    snapshot_conf = snapshot_config(config)
+    directory = snapshot_conf['PATH']
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, snapshot_filename(datetime.now()))
+    # Both steps write to temporary files first so a failed snapshot never looks like a finished one
+    copy_fd, copy_path = tempfile.mkstemp(suffix='.db', dir=directory)
+    os.close(copy_fd)
+    try:
+        copy_database(copy_path, snapshot_conf['PAGES'], snapshot_conf['SLEEP'])
+        compress_file(copy_path, path + '.part')
+        os.replace(path + '.part', path)
+    finally:
+        for leftover in (copy_path, path + '.part'):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+    info(f"Saved database snapshot {path} ({os.path.getsize(path)} bytes)")
+    if (deleted := prune_snapshots(directory, snapshot_conf['RETENTION'])):
+        info(f"Deleted {deleted} old database snapshots")
+    return path
+
+def export_snapshot(config: dict) -> Iterator[bytes]:
+    """
+    Generates a zstd compressed snapshot of the database piece by piece, the uncompressed copy is deleted afterwards
+    """
+    snapshot_conf = snapshot_config(config)
+    copy_fd, copy_path = tempfile.mkstemp(suffix='.db')
+    os.close(copy_fd)
+    try:
+        copy_database(copy_path, snapshot_conf['PAGES'], snapshot_conf['SLEEP'])
+        yield from compress_chunks(file_chunks(copy_path), ExportCompression.ZSTD)
+    finally:
+        os.remove(copy_path)
@@ -0,0 +1,107 @@
+"""
+Streaming CSV and NDJSON exports of the main tables
+
+Rows are read with a server-side cursor and written out in chunks as they come,
+so memory use doesn't depend on the size of the table
+"""
+
+import csv
+import io
+import json
+import zlib
+from enum import StrEnum
+from typing import Iterator
+
+from pyzstd import ZstdCompressor
+
+from db import User, Article, Correction, PageSnapshot
+
+# Bytes of output collected before a chunk is sent
+CHUNK_SIZE = 64*1024
+
+class ExportFormat(StrEnum):
+    CSV = "csv"
+    NDJSON = "ndjson"
+
+class ExportCompression(StrEnum):
+    NONE = "none"
+    GZIP = "gzip"
+    ZSTD = "zstd"
+
+MIMETYPES = {
+    ExportFormat.CSV: "text/csv",
+    ExportFormat.NDJSON: "application/x-ndjson",
+    ExportCompression.GZIP: "application/gzip",
+    ExportCompression.ZSTD: "application/zstd",
+}
+
+EXTENSIONS = {
+    ExportCompression.NONE: "",
+    ExportCompression.GZIP: ".gz",
+    ExportCompression.ZSTD: ".zst",
+}
+
+# Exported columns of each table, passwords and other internals stay out
+EXPORTS = {
+    'users': (User, [User.id, User.nickname, User.wikidot, User.discord, User.display_name]),
+    'articles': (Article, [Article.id, Article.name, Article.link, Article.words, Article.bonus, Article.added, Article.is_original,
+                           Article.author, Article.corrector, Article.corrected, Article.series, Article.is_scp]),
+    'corrections': (Correction, [Correction.article, Correction.author, Correction.corrector, Correction.timestamp, Correction.words, Correction.name]),
+    # Manifest of the snapshot store, the blobs can't be matched to pages without it
+    'snapshots': (PageSnapshot, [PageSnapshot.id, PageSnapshot.source_wiki, PageSnapshot.slug, PageSnapshot.revision, PageSnapshot.blob,
+                                 PageSnapshot.size, PageSnapshot.created]),
+}
+
+def export_rows(table: str) -> tuple[list[str], Iterator[tuple]]:
+    model, columns = EXPORTS[table]
+    query = model.select(*columns).order_by(columns[0]).tuples()
+    # iterator() doesn't keep the rows around after they've been read
+    return [c.name for c in columns], query.iterator()
+
+def csv_chunks(header: list[str], rows: Iterator[tuple]) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= CHUNK_SIZE:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+def ndjson_chunks(header: list[str], rows: Iterator[tuple]) -> Iterator[bytes]:
+    chunk, size = [], 0
+    for row in rows:
+        line = json.dumps(dict(zip(header, row)), ensure_ascii=False, default=str) + "\n"
+        chunk.append(line)
+        size += len(line)
+        if size >= CHUNK_SIZE:
+            yield "".join(chunk).encode('utf-8')
+            chunk, size = [], 0
+    yield "".join(chunk).encode('utf-8')
+
+def compress_chunks(chunks: Iterator[bytes], compression: ExportCompression) -> Iterator[bytes]:
+    if compression == ExportCompression.NONE:
+        yield from chunks
+        return
+    # wbits=31 writes a gzip header instead of a raw zlib stream
+    compressor = zlib.compressobj(wbits=31) if compression == ExportCompression.GZIP else ZstdCompressor()
+    for chunk in chunks:
+        if data := compressor.compress(chunk):
+            yield data
+    yield compressor.flush()
+
+def export_table(table: str, format: ExportFormat, compression: ExportCompression) -> Iterator[bytes]:
+    """
+    Generates the export of a table piece by piece
+    """
+    header, rows = export_rows(table)
+    chunks = csv_chunks(header, rows) if format == ExportFormat.CSV else ndjson_chunks(header, rows)
+    return compress_chunks(chunks, compression)
+
+def export_filename(table: str, date: str, format: ExportFormat, compression: ExportCompression) -> str:
+    return f"scp_{table}_{date}.{format}{EXTENSIONS[compression]}"
+
+def export_mimetype(format: ExportFormat, compression: ExportCompression) -> str:
+    return MIMETYPES[format if compression == ExportCompression.NONE else compression]
@@ -6,13 +6,17 @@ Classes are instantiated here, but are ready for use only after init_app is call
 from flask_apscheduler import APScheduler
 from flask_login import LoginManager
 from flask_discord import DiscordOAuth2Session
+from flask_caching import Cache
 from connectors.rss import RSSMonitor
 from connectors.discord import DiscordWebhook
 from connectors.portainer import PortainerConnector
+from connectors.snapshotqueue import SnapshotQueue
 
 sched = APScheduler()
 login_manager = LoginManager()
 oauth = DiscordOAuth2Session()
 rss = RSSMonitor()
 webhook = DiscordWebhook()
-portainer = PortainerConnector()
\ No newline at end of file
+portainer = PortainerConnector()
+cache = Cache()
+snapshot_queue = SnapshotQueue()
\ No newline at end of file
@@ -1,25 +1,51 @@
 import os
-from logging import error
-from flask import render_template_string
+from logging import error, debug
 from typing import Any
+from jinja2 import Environment, FileSystemLoader
 from jinja2.exceptions import TemplateError
 from werkzeug.routing import BuildError
 from flask import current_app
 
+TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), 'templates')
+
 class FrameworkError(RuntimeError):
     pass
 
-def render_template_file(file: str | bytes | os.PathLike, **context: Any) -> str | None:
-    try:
-        with open(file, 'r', encoding="utf-8") as template:
-            template_str = template.read()
-            with current_app.app_context():
-                return render_template_string(template_str, **context)
-    except TemplateError as e:
-        error(f"Error rendering template: {str(e)}")
-        return None
-    except BuildError as e:
-        error(f"Template render failed ({str(e)}) (Invalid url_for??)")
-    except Exception as e:
-        error(f"Failed to open template file {file}: {str(e)}")
-        return None
\ No newline at end of file
+class TemplateRegistry:
+    """
+    Compiles the framework templates once per app and renders them from the compiled objects
+
+    The environment is an overlay of the app's Jinja environment, so url_for and the other globals still work.
+    Templates are only checked for changes on disk in debug mode.
+    """
+
+    EXTENSION_KEY = 'framework_templates'
+
+    def __init__(self, directory: str | os.PathLike = TEMPLATE_DIR):
+        self.directory = directory
+
+    def environment(self) -> Environment:
+        env = current_app.extensions.get(self.EXTENSION_KEY)
+        if env is None:
+            env = current_app.jinja_env.overlay(loader=FileSystemLoader(self.directory), auto_reload=current_app.debug)
+            # Compile everything up front so the first render of each template isn't slower
+            for name in env.list_templates(extensions=['j2']):
+                env.get_template(name)
+            debug(f"Compiled framework templates from {self.directory}")
+            current_app.extensions[self.EXTENSION_KEY] = env
+        return env
+
+    def render(self, template: str, **context: Any) -> str | None:
+        try:
+            return self.environment().get_template(template).render(**context)
+        except TemplateError as e:
+            error(f"Error rendering template {template}: {str(e)}")
+            return None
+        except BuildError as e:
+            error(f"Template render failed ({str(e)}) (Invalid url_for??)")
+            return None
+
+templates = TemplateRegistry()
+
+def render_framework_template(template: str, **context: Any) -> str | None:
+    return templates.render(template, **context)
@@ -1,5 +1,5 @@
 from logging import critical, info
-from .framework import render_template_file, FrameworkError
+from .framework import render_framework_template, FrameworkError
 import yaml
 import time
 import os
@@ -28,7 +28,7 @@ def navigation_menu(authorized: bool = False):
     for item in menu_config['menu']:
         menuitem = list(item.values())[0]
         # Render the template for the current list item
-        rendered = render_template_file(os.path.join(current_dir, 'templates', 'menu_item.j2'),
+        rendered = render_framework_template('menu_item.j2',
                                         handler=menuitem['handler'],
                                         text=menuitem['text'],
                                         icon=menuitem['icon'],
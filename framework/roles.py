@@ -1,12 +1,56 @@
 import yaml
+from bisect import bisect_right
+from dataclasses import dataclass, field
 from logging import info, error, critical
-from functools import lru_cache
-from .framework import render_template_file, FrameworkError
+from typing import Iterable
+from .framework import render_framework_template, FrameworkError
 import os
 
 MODULE_DIR = os.path.dirname(__file__)
 role_cache = None
 
+@dataclass
+class RoleTable:
+    """
+    Roles of one type compiled into an ascending list of point limits, so a role can be found with bisect
+    """
+    min_points: float
+    no_role: dict
+    thresholds: list[float]
+    roles: list[dict]
+    # Rendered badge HTML for each (role index, classes, override_classes), -1 is no_role
+    badges: dict = field(default_factory=dict)
+
+    @classmethod
+    def compile(cls, role_type: dict) -> "RoleTable":
+        roles = sorted(role_type['roles'], key=lambda r: r['point_limit'])
+        return cls(role_type['min_points'], role_type['no_role'], [r['point_limit'] for r in roles], roles)
+
+    def index(self, points: float) -> int | None:
+        if points < self.min_points: return -1
+        # Index of the highest limit that is <= points
+        position = bisect_right(self.thresholds, points) - 1
+        # Above min_points but under every limit, which only happens with a misconfigured role file
+        return position if position >= 0 else None
+
+    def role(self, index: int | None) -> dict | None:
+        if index is None: return None
+        return self.no_role if index == -1 else self.roles[index]
+
+    def get(self, points: float) -> dict | None:
+        return self.role(self.index(points))
+
+    def badge(self, index: int | None, classes: str = "", override_classes: bool = False) -> str | None:
+        key = (index, classes, override_classes)
+        if key not in self.badges:
+            role = self.role(index)
+            if role is None: return None
+            self.badges[key] = render_framework_template('role_badge.j2',\
+                                name=role['name'],\
+                                classes=role['badge_css']+f" {classes}",\
+                                override_classes=override_classes)
+        return self.badges[key]
+
 def load_role_file():
     global role_cache
     try:
@@ -17,33 +61,38 @@ def load_role_file():
         critical(f"Framework error: failed to load roles ({str(e)})")
         raise FrameworkError(f"Failed to load roles ({str(e)})")
     if not isinstance(role_data, dict):
-        print(role_data)
         critical(f"Framework error: malformed role configuration")
         raise FrameworkError("Malformed role configuration")
-    for role_type, data in role_data.items():
-        role_data[role_type].get("roles").sort(key=lambda r: r['point_limit'], reverse=True)
-    role_cache = role_data
+    role_cache = {role_type: RoleTable.compile(data) for role_type, data in role_data.items()}
+    info(f"Loaded {sum(len(t.roles) for t in role_cache.values())} roles")
 
-# This one doesn't strictly need to be cached as the config is only loaded once but whatever
-@lru_cache(maxsize=4096)
-def get_role(points, type='translator'):
-    global role_cache # Evil ass global variable 
+def get_role_table(type='translator') -> RoleTable | None:
     if role_cache is None:
         load_role_file()
     if not role_cache.get(type, None):
         error(f"No role badge configured for type \"{type}\"")
-        return ""
-    role_type = role_cache[type]
-    if points < role_type['min_points']: return role_type['no_role']
-    for role in role_type['roles']:
-        if role['point_limit'] <= points:
-            return role
-
-# Caching to not use unnecessary I/O
-@lru_cache(maxsize=4096)
+        return None
+    return role_cache[type]
+
+def get_role(points, type='translator'):
+    table = get_role_table(type)
+    return table.get(points) if table else ""
+
+def assign_roles(points: Iterable[float], type='translator') -> list:
+    """
+    Finds the role for each value in a column of points
+    """
+    table = get_role_table(type)
+    if not table: return ["" for _ in points]
+    return [table.get(p) for p in points]
+
+def role_badges(points: Iterable[float], type='translator', classes="", override_classes = False) -> list[str]:
+    """
+    Role badge HTML for each value in a column of points, badges are rendered once per role
+    """
+    table = get_role_table(type)
+    if not table: return ["" for _ in points]
+    return [table.badge(table.index(p), classes, override_classes) for p in points]
+
 def role_badge(points, type='translator', classes="", override_classes = False) -> str:
-    role = get_role(points, type)
-    return render_template_file(os.path.join(MODULE_DIR, 'templates', 'role_badge.j2'),\
-                                name=role['name'],\
-                                classes=role['badge_css']+f" {classes}",\
-                                override_classes=override_classes)
\ No newline at end of file
+    return role_badges((points,), type, classes, override_classes)[0]
@@ -0,0 +1,220 @@
+"""
+Bulk import of articles and users from CSV or JSON
+
+Records are validated as a whole batch: duplicates and authors are looked up with one query per chunk
+instead of one per record, rows go in with insert_many in chunked transactions
+and role changes are worked out once for the whole batch
+"""
+
+import csv
+import datetime
+import io
+import json
+from dataclasses import dataclass, field
+from enum import StrEnum
+from logging import info
+
+from peewee import fn
+
+from db import database, Article, User, Leaderboard, parse_series, canonical_link
+from framework.roles import get_role
+from extensions import webhook
+
+# Rows per insert_many and per IN (...) lookup, well under SQLite's variable limit
+IMPORT_CHUNK = 500
+
+class ImportFormat(StrEnum):
+    CSV = "csv"
+    JSON = "json"
+
+class ImportDataError(ValueError):
+    pass
+
+@dataclass
+class ImportResult:
+    inserted: int = 0
+    # (record number, reason) for each record that wasn't imported
+    skipped: list = field(default_factory=list)
+    # (user, new role) for each author who crossed a role threshold
+    promotions: list = field(default_factory=list)
+
+    def to_dict(self) -> dict:
+        return {
+            'inserted': self.inserted,
+            'skipped': [{'record': n, 'reason': reason} for n, reason in self.skipped],
+            'promotions': [{'id': user.id, 'nickname': user.nickname, 'role': role['name']} for user, role in self.promotions]
+        }
+
+def parse_records(data: str, format: ImportFormat) -> list[dict]:
+    """
+    Reads a list of records from a CSV file with a header row or a JSON array of objects
+    """
+    if format == ImportFormat.CSV:
+        return list(csv.DictReader(io.StringIO(data)))
+    try:
+        records = json.loads(data)
+    except json.JSONDecodeError as e:
+        raise ImportDataError(f"Invalid JSON ({str(e)})")
+    if not isinstance(records, list) or not all(isinstance(r, dict) for r in records):
+        raise ImportDataError("Expected a JSON array of objects")
+    return records
+
+def chunks(items: list, size: int = IMPORT_CHUNK):
+    for start in range(0, len(items), size):
+        yield items[start:start+size]
+
+def existing_values(column, values: set) -> set:
+    found = set()
+    for chunk in chunks(list(values)):
+        found.update(v for (v,) in column.model.select(column).where(column.in_(chunk)).tuples())
+    return found
+
+def insert_chunked(model, rows: list[dict]) -> None:
+    for chunk in chunks(rows):
+        # Each chunk is its own transaction so a big import doesn't hold the write lock the whole time
+        with database.atomic():
+            model.insert_many(chunk).execute()
+
+def text(record: dict, key: str) -> str:
+    value = record.get(key)
+    return str(value).strip() if value is not None else ""
+
+def integer(record: dict, key: str, default: int | None = None) -> int | None:
+    value = text(record, key)
+    if not value:
+        return default
+    return int(value)
+
+def boolean(record: dict, key: str) -> bool:
+    value = record.get(key)
+    if isinstance(value, bool):
+        return value
+    return text(record, key).lower() in ('1', 'true', 'yes', 'ano')
+
+def timestamp(record: dict, key: str) -> datetime.datetime | None:
+    value = text(record, key)
+    return datetime.datetime.fromisoformat(value) if value else None
+
+def resolve_users(references: set[str]) -> dict[str, User]:
+    """
+    Maps user references (ID, nickname or Wikidot username) to users
+    """
+    ids = {int(r) for r in references if r.isdigit()}
+    names = {r.lower() for r in references}
+    resolved = {}
+    for chunk in chunks(list(ids)):
+        resolved.update({str(u.id): u for u in User.select().where(User.id.in_(chunk))})
+    for chunk in chunks(list(names)):
+        for user in User.select().where(fn.LOWER(User.nickname).in_(chunk) | fn.LOWER(User.wikidot).in_(chunk)):
+            resolved.setdefault(user.nickname.lower(), user)
+            resolved.setdefault(user.wikidot.lower(), user)
+    return {r: resolved.get(r) or resolved.get(r.lower()) for r in references}
+
+def role_promotions(gains: dict[int, float]) -> list[tuple[User, dict]]:
+    """
+    Compares each author's role before and after adding the points they gained
+    """
+    promotions = []
+    for chunk in chunks(list(gains)):
+        for stats in Leaderboard.select(Leaderboard, User).join(User).where(Leaderboard.user.in_(chunk)):
+            current_role = get_role(stats.points)
+            next_role = get_role(stats.points + gains[stats.user.id])
+            if current_role != next_role:
+                promotions.append((stats.user, next_role))
+    return promotions
+
+def notify_promotions(promotions: list[tuple[User, dict]]) -> None:
+    for user, role in promotions:
+        if user.discord:
+            webhook.send_text(f'Uživatel {user.nickname} (<@{user.discord}>) dosáhl hranice pro roli {role["name"]}!')
+
+def normalize_title(title: str) -> str:
+    # Same as adding an article by hand
+    return title.upper() if title.lower().startswith('scp') else title
+
+def import_articles(records: list[dict], dry_run: bool = False) -> ImportResult:
+    """
+    Imports articles, records have a name, words, author (ID, nickname or Wikidot username)
+    and optionally bonus, link, is_original, added, corrector and corrected
+    """
+    result = ImportResult()
+    authors = resolve_users({text(r, 'author') for r in records} | {text(r, 'corrector') for r in records if text(r, 'corrector')})
+    existing = existing_values(Article.name, {normalize_title(text(r, 'name')) for r in records if text(r, 'name')})
+    existing_links = existing_values(Article.link_key, {canonical_link(text(r, 'link')) for r in records} - {None})
+
+    rows, seen, seen_links, gains = [], set(), set(), {}
+    for number, record in enumerate(records, start=1):
+        name = normalize_title(text(record, 'name'))
+        try:
+            words, bonus = integer(record, 'words'), integer(record, 'bonus', 0)
+            added, corrected = timestamp(record, 'added'), timestamp(record, 'corrected')
+        except ValueError as e:
+            result.skipped.append((number, f"Invalid value ({str(e)})"))
+            continue
+        author = authors.get(text(record, 'author'))
+        corrector = authors.get(text(record, 'corrector')) if text(record, 'corrector') else None
+        link_key = canonical_link(text(record, 'link'))
+        if not name or words is None:
+            result.skipped.append((number, "Missing name or word count"))
+        elif name in existing or name in seen:
+            result.skipped.append((number, f"Article {name} already exists"))
+        elif link_key is not None and (link_key in existing_links or link_key in seen_links):
+            result.skipped.append((number, f"An article with the link {text(record, 'link')} already exists"))
+        elif author is None:
+            result.skipped.append((number, f"Unknown author {text(record, 'author')}"))
+        elif text(record, 'corrector') and corrector is None:
+            result.skipped.append((number, f"Unknown corrector {text(record, 'corrector')}"))
+        else:
+            seen.add(name)
+            if link_key is not None:
+                seen_links.add(link_key)
+            is_original = boolean(record, 'is_original')
+            series, is_scp = parse_series(name)
+            rows.append({
+                'name': name, 'words': words, 'bonus': bonus, 'link': text(record, 'link') or None, 'link_key': link_key,
+                'is_original': is_original, 'author': author.id, 'corrector': corrector.id if corrector else None,
+                'added': added or datetime.datetime.now(), 'corrected': corrected, 'series': series, 'is_scp': is_scp
+            })
+            # Same as the leaderboard triggers, originals only count for their bonus
+            gains[author.id] = gains.get(author.id, 0) + (0 if is_original else words/1000) + bonus
+
+    # Has to be done before the insert, the triggers update the points right away
+    result.promotions = role_promotions(gains)
+    if not dry_run:
+        insert_chunked(Article, rows)
+        info(f"Imported {len(rows)} articles ({len(result.skipped)} skipped)")
+    result.inserted = len(rows)
+    return result
+
+def import_users(records: list[dict], dry_run: bool = False) -> ImportResult:
+    """
+    Imports users, records have a nickname, wikidot and optionally discord
+    """
+    result = ImportResult()
+    nicknames = existing_values(User.nickname, {text(r, 'nickname') for r in records})
+    wikidots = existing_values(User.wikidot, {text(r, 'wikidot') for r in records})
+
+    rows = []
+    for number, record in enumerate(records, start=1):
+        nickname, wikidot, discord = text(record, 'nickname'), text(record, 'wikidot'), text(record, 'discord')
+        if not nickname or not wikidot:
+            result.skipped.append((number, "Missing nickname or Wikidot username"))
+        elif discord and (len(discord) not in (18, 19) or not discord.isdigit()):
+            result.skipped.append((number, f"Invalid Discord ID {discord}"))
+        elif nickname in nicknames or wikidot in wikidots:
+            result.skipped.append((number, f"User {nickname} already exists"))
+        else:
+            nicknames.add(nickname)
+            wikidots.add(wikidot)
+            rows.append({'nickname': nickname, 'wikidot': wikidot, 'discord': discord or None})
+
+    if not dry_run:
+        insert_chunked(User, rows)
+        info(f"Imported {len(rows)} users ({len(result.skipped)} skipped)")
+    result.inserted = len(rows)
+    return result
+
+IMPORTERS = {
+    'articles': import_articles,
+    'users': import_users,
+}
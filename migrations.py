@@ -0,0 +1,244 @@
+# Builtins
+from logging import info, warning, debug
+from collections import defaultdict
+from typing import Callable, List, Tuple
+
+# External
+from peewee import SqliteDatabase, Field, IntegerField, BooleanField, TextField, fn
+from playhouse.migrate import SqliteMigrator, migrate, make_index_name
+
+# Internal
+import db
+from db import SchemaVersion, SeriesStats, OTHER_SERIES, parse_series, canonical_link, User, Article, Leaderboard, Correction, ArticleSearch, UserSearch, FRONTPAGE_SORTS
+
+# Every migration is a (version, name, function) tuple, registered with the @migration decorator
+# Migrations run in order of their version number and each one is applied in its own transaction
+MIGRATIONS: List[Tuple[int, str, Callable[[SqliteMigrator], None]]] = []
+
+def migration(version: int, name: str):
+    """
+    Registers a function as the migration to a schema version
+
+    Tables created by peewee on a fresh database already contain all columns,
+    so migrations should only use the helpers below, which skip objects that already exist
+    """
+    def decorator(func: Callable[[SqliteMigrator], None]):
+        if any(v == version for v, _, _ in MIGRATIONS):
+            raise ValueError(f"Duplicate migration version {version}")
+        MIGRATIONS.append((version, name, func))
+        return func
+    return decorator
+
+def add_index(migrator: SqliteMigrator, table: str, columns: Tuple[str, ...], unique: bool = False) -> None:
+    # Peewee indexes foreign keys on its own, so the same index might exist under a different name
+    if any(tuple(i.columns) == tuple(columns) for i in migrator.database.get_indexes(table)):
+        debug(f"Index {make_index_name(table, columns)} already exists")
+        return
+    migrate(migrator.add_index(table, columns, unique))
+
+def add_column(migrator: SqliteMigrator, table: str, column: str, field: Field) -> None:
+    if column in [c.name for c in migrator.database.get_columns(table)]:
+        debug(f"Column {table}.{column} already exists")
+        return
+    migrate(migrator.add_column(table, column, field))
+
+def add_expression_index(migrator: SqliteMigrator, name: str, table: str, expression: str, unique: bool = False) -> None:
+    # The migrator can only index plain columns
+    migrator.database.execute_sql(f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS {name} ON {table} ({expression});")
+
+def get_schema_version(database: SqliteDatabase) -> int:
+    return SchemaVersion.select(SchemaVersion.version).order_by(SchemaVersion.version.desc()).scalar() or 0
+
+def run_migrations(database: SqliteDatabase) -> int:
+    """
+    Applies all pending migrations and returns the current schema version
+
+    Views have to be dropped with drop_views before and recreated with create_views afterwards
+    """
+    database.create_tables([SchemaVersion])
+    migrator = SqliteMigrator(database)
+    current = get_schema_version(database)
+    for version, name, func in sorted(MIGRATIONS, key=lambda m: m[0]):
+        if version <= current:
+            continue
+        info(f"Applying migration {version} ({name})")
+        with database.atomic():
+            func(migrator)
+            SchemaVersion.create(version=version, name=name)
+        current = version
+    debug(f"Database schema is at version {current}")
+    return current
+
+# ===== QUERY PLANS =====
+
+def main_queries() -> dict:
+    """
+    Returns the hot queries that should always be served by an index, keyed by a descriptive name
+    """
+    queries = {f'leaderboard ({sort})': db.frontpage_query(sort) for sort in FRONTPAGE_SORTS}
+    queries |= {
+        'last update': Article.select(fn.MAX(Article.added)),
+        'user stats': Leaderboard.select().where(Leaderboard.user == 1),
+        'user translations': Article.select().where((Article.is_original == False) & (Article.author == 1)).order_by(Article.added.desc()),
+        'user corrections': Correction.select().where(Correction.corrector == 1),
+        'article by name': Article.select().where(Article.name == ''),
+        'article by link': Article.select().where(Article.link_key == ''),
+        'user by wikidot name': User.select().where(fn.LOWER(User.wikidot) == ''),
+        'pending RSS updates by type': db.rss_updates_query(update_type=0),
+        'pending RSS updates by feed': db.rss_updates_query(feed=''),
+    }
+    return queries
+
+def find_table_scans(database: SqliteDatabase) -> dict[str, List[str]]:
+    """
+    Runs EXPLAIN QUERY PLAN on all main queries and returns the plan steps that scan a whole table
+    """
+    scans = {}
+    for name, query in main_queries().items():
+        sql, params = query.sql()
+        plan = database.execute_sql(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+        # Each row is (id, parent, notused, detail), index scans are fine since they're ordered and limited
+        bad_steps = [row[3] for row in plan if row[3].startswith('SCAN') and 'INDEX' not in row[3]]
+        if bad_steps:
+            scans[name] = bad_steps
+    return scans
+
+def check_query_plans(database: SqliteDatabase) -> bool:
+    scans = find_table_scans(database)
+    for name, steps in scans.items():
+        warning(f"Query \"{name}\" falls back to a full table scan ({'; '.join(steps)})")
+    return not scans
+
+# ===== MIGRATIONS =====
+
+@migration(1, "Indexes for hot filters")
+def add_hot_filter_indexes(migrator: SqliteMigrator):
+    # Covers the per-user article lists, which filter by type and order by date
+    add_index(migrator, 'Article', ('idauthor', 'is_original', 'added'))
+    add_index(migrator, 'Article', ('idcorrector',))
+    add_index(migrator, 'Article', ('link',))
+    # Duplicate check when adding articles
+    add_index(migrator, 'Article', ('name',))
+    # Latest update shown on the front page
+    add_index(migrator, 'Article', ('added',))
+    # RSS author lookup and the alphabetical leaderboard
+    add_expression_index(migrator, 'user_wikidot_lower', 'User', 'LOWER(wikidot)')
+    add_expression_index(migrator, 'user_nickname_nocase', 'User', 'nickname COLLATE NOCASE')
+
+# The part of the link after the wiki's domain, eg. "scp-173" for http://scp-cs.wikidot.com/scp-173
+ARTICLE_SLUG_SQL = "CASE WHEN INSTR({0}.link, '.wikidot.com/') > 0 THEN SUBSTR({0}.link, INSTR({0}.link, '.wikidot.com/') + 13) ELSE '' END"
+
+@migration(2, "Full-text article search")
+def add_article_search(migrator: SqliteMigrator):
+    database = migrator.database
+    ArticleSearch.create_table()
+    database.execute_sql(f"CREATE TRIGGER IF NOT EXISTS article_search_insert AFTER INSERT ON Article\
+    BEGIN\
+        INSERT INTO ArticleSearch (rowid, name, slug) VALUES (NEW.id, NEW.name, {ARTICLE_SLUG_SQL.format('NEW')});\
+    END;")
+    database.execute_sql("CREATE TRIGGER IF NOT EXISTS article_search_delete AFTER DELETE ON Article\
+    BEGIN\
+        DELETE FROM ArticleSearch WHERE rowid = OLD.id;\
+    END;")
+    database.execute_sql(f"CREATE TRIGGER IF NOT EXISTS article_search_update AFTER UPDATE OF name, link ON Article\
+    BEGIN\
+        UPDATE ArticleSearch SET name = NEW.name, slug = {ARTICLE_SLUG_SQL.format('NEW')} WHERE rowid = NEW.id;\
+    END;")
+    # Index the existing articles
+    database.execute_sql("DELETE FROM ArticleSearch;")
+    database.execute_sql(f"INSERT INTO ArticleSearch (rowid, name, slug) SELECT id, name, {ARTICLE_SLUG_SQL.format('Article')} FROM Article;")
+
+@migration(3, "User search index")
+def add_user_search(migrator: SqliteMigrator):
+    database = migrator.database
+    UserSearch.create_table()
+    database.execute_sql("CREATE TRIGGER IF NOT EXISTS user_search_insert AFTER INSERT ON User\
+    BEGIN\
+        INSERT INTO UserSearch (rowid, nickname, display_name, wikidot, discord)\
+            VALUES (NEW.id, NEW.nickname, NEW.display_name, NEW.wikidot, NEW.discord);\
+    END;")
+    database.execute_sql("CREATE TRIGGER IF NOT EXISTS user_search_delete AFTER DELETE ON User\
+    BEGIN\
+        DELETE FROM UserSearch WHERE rowid = OLD.id;\
+    END;")
+    database.execute_sql("CREATE TRIGGER IF NOT EXISTS user_search_update AFTER UPDATE OF nickname, display_name, wikidot, discord ON User\
+    BEGIN\
+        UPDATE UserSearch SET nickname = NEW.nickname, display_name = NEW.display_name, wikidot = NEW.wikidot, discord = NEW.discord\
+            WHERE rowid = NEW.id;\
+    END;")
+    database.execute_sql("DELETE FROM UserSearch;")
+    database.execute_sql("INSERT INTO UserSearch (rowid, nickname, display_name, wikidot, discord)\
+        SELECT id, nickname, display_name, wikidot, discord FROM User;")
+
+@migration(4, "Precomputed series statistics")
+def add_series_stats(migrator: SqliteMigrator):
+    database = migrator.database
+    add_column(migrator, 'Article', 'series', IntegerField(null=True))
+    # Nullable, a NOT NULL column makes the migrator rebuild the table, which drops the search triggers
+    # The update below fills it in for every article anyway
+    add_column(migrator, 'Article', 'is_scp', BooleanField(null=True))
+    add_index(migrator, 'Article', ('series',))
+
+    # Parse the series of existing articles the same way Article.save does
+    series_ids = defaultdict(list)
+    for article_id, name in Article.select(Article.id, Article.name).tuples():
+        series_ids[parse_series(name)].append(article_id)
+    for (series, is_scp), ids in series_ids.items():
+        Article.update(series=series, is_scp=is_scp).where(Article.id.in_(ids)).execute()
+
+    SeriesStats.create_table()
+    database.execute_sql("DELETE FROM SeriesStats;")
+    database.execute_sql(f"INSERT INTO SeriesStats (series, articles, words)\
+        SELECT IFNULL(series, {OTHER_SERIES}), COUNT(id), TOTAL(words) FROM Article WHERE is_original = FALSE GROUP BY 1;")
+
+    add_translation = f"INSERT INTO SeriesStats (series, articles, words) VALUES (IFNULL(NEW.series, {OTHER_SERIES}), 1, NEW.words)\
+        ON CONFLICT (series) DO UPDATE SET articles = articles + 1, words = words + excluded.words;"
+    remove_translation = f"UPDATE SeriesStats SET articles = articles - 1, words = words - OLD.words\
+        WHERE series = IFNULL(OLD.series, {OTHER_SERIES});"
+
+    # Only translations are counted, the WHEN clauses take care of that
+    database.execute_sql(f"CREATE TRIGGER IF NOT EXISTS series_stats_insert AFTER INSERT ON Article WHEN NEW.is_original = FALSE\
+    BEGIN {add_translation} END;")
+    database.execute_sql(f"CREATE TRIGGER IF NOT EXISTS series_stats_delete AFTER DELETE ON Article WHEN OLD.is_original = FALSE\
+    BEGIN {remove_translation} END;")
+    database.execute_sql(f"CREATE TRIGGER IF NOT EXISTS series_stats_update_old AFTER UPDATE OF series, words, is_original ON Article\
+    WHEN OLD.is_original = FALSE\
+    BEGIN {remove_translation} END;")
+    database.execute_sql(f"CREATE TRIGGER IF NOT EXISTS series_stats_update_new AFTER UPDATE OF series, words, is_original ON Article\
+    WHEN NEW.is_original = FALSE\
+    BEGIN {add_translation} END;")
+
+    # Replaced by the table above
+    database.execute_sql("DROP VIEW IF EXISTS Series;")
+    database.execute_sql("DROP VIEW IF EXISTS Statistics;")
+
+@migration(5, "Per-user data version")
+def add_user_version(migrator: SqliteMigrator):
+    # The triggers that bump it are created with the rest in db.create_triggers
+    add_column(migrator, 'Leaderboard', 'version', IntegerField(default=0))
+    # The old trigger doesn't fill in the version, so the insert would be ignored
+    migrator.database.execute_sql("DROP TRIGGER IF EXISTS leaderboard_user_insert;")
+
+@migration(6, "Canonical article links")
+def add_article_link_key(migrator: SqliteMigrator):
+    add_column(migrator, 'Article', 'link_key', TextField(null=True))
+
+    # The oldest article keeps a duplicate link, the unique index wouldn't get created otherwise
+    keys = {}
+    for article_id, link in Article.select(Article.id, Article.link).order_by(Article.id).tuples():
+        key = canonical_link(link)
+        if key is None:
+            continue
+        if key in keys:
+            warning(f"Articles {keys[key]} and {article_id} have the same link ({link}), only the first one can be found by it")
+            continue
+        keys[key] = article_id
+    for key, article_id in keys.items():
+        Article.update(link_key=key).where(Article.id == article_id).execute()
+
+    add_index(migrator, 'Article', ('link_key',), unique=True)
+
+@migration(7, "Snapshot job batches")
+def add_snapshot_job_batch(migrator: SqliteMigrator):
+    add_column(migrator, 'SnapshotJob', 'batch', TextField(null=True))
+    add_index(migrator, 'SnapshotJob', ('batch', 'status'))
@@ -0,0 +1,91 @@
+"""
+Benchmark of the word counter on generated Wikidot pages
+
+The pages mix text with the markup found on real articles (CSS modules, includes, collapsibles, tables, links),
+the number of words in each is known so the counts are checked as well.
+Run from the repository root: python scripts/benchmark_wordcount.py [--pages N] [--workers N]
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from snapshot_store import SnapshotStore
+import wordcount
+
+VOCABULARY = ["SCP-173", "nadace", "objekt", "it's", "containment", "procedures", "příběh", "D-9341", "zaměstnanec", "the", "anomalous", "1998"]
+
+# Markup that doesn't add any words
+MARKUP = [
+    "[[module CSS]]\n#page-title { display: none; }\n.scp-image-block { width: 300px; }\n[[/module]]\n",
+    "[[include :scp-wiki:component:license-box\n|author=Someone\n]]\n",
+    "[[include :scp-wiki:component:license-box-end]]\n",
+    "[[module Rate]]\n",
+    "[[>]]\n[[image scp-173.jpg width=\"300px\"]]\n[[/>]]\n",
+    "[!-- Poznámka překladatele --]\n",
+    "[[code type=\"css\"]]\nbody { margin: 0; }\n[[/code]]\n",
+    "[[toc]]\n",
+    "----\n",
+]
+
+def paragraph(words: int) -> str:
+    return " ".join(random.choice(VOCABULARY) for _ in range(words))
+
+def generate_page(size: int) -> tuple[str, int]:
+    """
+    Returns the source of a page and the number of words in it
+    """
+    parts, words = [], 0
+    while words < size:
+        parts.append(random.choice(MARKUP))
+        match random.randrange(5):
+            case 0:
+                parts.append(f"**Objekt:** {paragraph(3)}\n\n")
+                words += 4
+            case 1:
+                parts.append(f"[[collapsible show=\"+ Otevřít\" hide=\"- Zavřít\"]]\n[[div class=\"blockquote\"]]\n{paragraph(40)}\n[[/div]]\n[[/collapsible]]\n")
+                words += 40
+            case 2:
+                parts.append(f"||~ {paragraph(2)} ||~ {paragraph(2)} ||\n|| {paragraph(5)} || {paragraph(5)} ||\n")
+                words += 14
+            case 3:
+                parts.append(f"{paragraph(20)} [[[scp-173|{paragraph(2)}]]] [https://scp-wiki.wikidot.com {paragraph(3)}] //{paragraph(4)}//\n\n")
+                words += 29
+            case _:
+                parts.append(f"+++ {paragraph(2)}\n{paragraph(60)}[[footnote]]{paragraph(8)}[[/footnote]]\n\n")
+                words += 70
+    return "".join(parts), words
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--pages', type=int, default=2000)
+    parser.add_argument('--words', type=int, default=3000, help="Average words per page")
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    with tempfile.TemporaryDirectory() as root:
+        store = SnapshotStore(root)
+        pages = [generate_page(random.randint(args.words // 2, args.words * 3 // 2)) for _ in range(args.pages)]
+        paths = [store.blob_path(store.put(source)) for source, _ in pages]
+        expected = [words for _, words in pages]
+        megabytes = sum(len(source.encode('utf-8')) for source, _ in pages) / 1024 / 1024
+        print(f"{args.pages} pages, {megabytes:.1f} MiB of source, {sum(expected)} words")
+
+        for workers in sorted({1, args.workers}):
+            start = time.perf_counter()
+            counts = wordcount.count_many(paths, workers=workers)
+            elapsed = time.perf_counter() - start
+            wrong = sum(count != words for count, words in zip(counts, expected))
+            print(f"{workers} worker{'s' if workers > 1 else ''}: {elapsed:.2f} s, {args.pages / elapsed:.0f} pages/s, {megabytes / elapsed:.1f} MiB/s, {wrong} wrong counts")
+            if wrong:
+                exit(1)
+
+if __name__ == '__main__':
+    main()
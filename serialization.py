@@ -0,0 +1,136 @@
+"""
+Column-projected serialization for API responses
+
+A Projection maps the keys of an API object to the columns they come from. Nested objects use
+double underscores in their keys (author__nickname becomes {"author": {"nickname": ...}}),
+related tables are joined only when a key that needs them is requested.
+Rows are fetched as plain dicts, so no model instances get built along the way.
+"""
+
+from peewee import JOIN, ModelSelect, fn
+
+from db import Article, User, Leaderboard
+
+class Projection:
+    def __init__(self, model, columns: dict, joins: dict | None = None, computed: tuple = ()):
+        self.model = model
+        self.columns = columns
+        # Top level key -> (model alias, join condition) pairs the key needs
+        self.joins = joins or {}
+        # Keys that aren't columns, the caller fills them in
+        self.computed = computed
+        self.fields = tuple(dict.fromkeys([path.split('__')[0] for path in columns] + list(computed)))
+
+    def parse_fields(self, value: str | None, default: tuple | None = None) -> tuple | None:
+        """
+        Parses a comma separated fields= parameter, returns None if it contains an unknown key
+        """
+        if not value:
+            return default or self.fields
+        fields = tuple(f.strip() for f in value.split(',') if f.strip())
+        if not fields or any(f not in self.fields for f in fields):
+            return None
+        return fields
+
+    def apply(self, query: ModelSelect, fields: tuple) -> ModelSelect:
+        """
+        Selects only the columns of the requested keys and joins what they need
+        """
+        query = query.select(*[column.alias(path) for path, column in self.columns.items() if path.split('__')[0] in fields])
+        joined = set()
+        for key in fields:
+            for alias, on in self.joins.get(key, ()):
+                if alias not in joined:
+                    query = query.join_from(self.model, alias, JOIN.LEFT_OUTER, on=on)
+                    joined.add(alias)
+        return query.dicts()
+
+    def serialize(self, rows, fields: tuple) -> list[dict]:
+        return [self.nest(row, fields) for row in rows]
+
+    def nest(self, row: dict, fields: tuple) -> dict:
+        result = {}
+        for path, value in row.items():
+            keys = path.split('__')
+            # Skips things like keyset sort columns too
+            if keys[0] not in fields or path not in self.columns:
+                continue
+            target = result
+            for key in keys[:-1]:
+                target = target.setdefault(key, {})
+            target[keys[-1]] = value
+        return drop_missing(result)
+
+def drop_missing(obj: dict) -> dict | None:
+    # A nested object without an ID comes from a LEFT JOIN that found nothing
+    for key, value in obj.items():
+        if isinstance(value, dict):
+            obj[key] = drop_missing(value)
+    return None if 'id' in obj and obj['id'] is None else obj
+
+def user_columns(prefix: str, user) -> dict:
+    return {
+        f'{prefix}__id': user.id,
+        f'{prefix}__nickname': user.nickname,
+        f'{prefix}__wikidot': user.wikidot,
+        f'{prefix}__discord': user.discord,
+        f'{prefix}__displayName': user.display_name,
+    }
+
+def display_name(user):
+    return fn.COALESCE(fn.NULLIF(user.display_name, ''), user.nickname)
+
+Author = User.alias('author')
+Corrector = User.alias('corrector')
+AUTHOR_JOIN = (Author, Article.author == Author.id)
+CORRECTOR_JOIN = (Corrector, Article.corrector == Corrector.id)
+
+def article_columns(prefix: str = '') -> dict:
+    return {
+        f'{prefix}id': Article.id,
+        f'{prefix}name': Article.name,
+        f'{prefix}words': Article.words,
+        f'{prefix}bonus': Article.bonus,
+        f'{prefix}added': Article.added,
+        **user_columns(f'{prefix}author', Author),
+        **user_columns(f'{prefix}corrector', Corrector),
+        f'{prefix}corrected': Article.corrected,
+        f'{prefix}link': Article.link,
+    }
+
+# Same shape as Article.to_dict
+ARTICLE = Projection(Article, article_columns(), joins={'author': [AUTHOR_JOIN], 'corrector': [CORRECTOR_JOIN]})
+
+# Same shape as Correction.to_dict, corrections are just articles with a corrector
+CORRECTION = Projection(Article, {
+    **article_columns('article__'),
+    **user_columns('author', Author),
+    **user_columns('corrector', Corrector),
+    'timestamp': Article.corrected,
+    'words': Article.words,
+}, joins={'article': [AUTHOR_JOIN, CORRECTOR_JOIN], 'author': [AUTHOR_JOIN], 'corrector': [CORRECTOR_JOIN]})
+
+# Search results have a shorter user object, articles without a corrector get a placeholder one
+ARTICLE_SEARCH = Projection(Article, {
+    'id': Article.id,
+    'name': Article.name,
+    'link': Article.link,
+    'words': Article.words,
+    'bonus': Article.bonus,
+    'added': Article.added,
+    'author__id': Author.id,
+    'author__name': display_name(Author),
+    'corrector__id': fn.IFNULL(Corrector.id, 0),
+    'corrector__name': fn.IFNULL(display_name(Corrector), 'N/A'),
+}, joins={'author': [AUTHOR_JOIN], 'corrector': [CORRECTOR_JOIN]})
+
+USER_SEARCH = Projection(Leaderboard, {
+    'id': User.id,
+    'nickname': User.nickname,
+    'discord': User.discord,
+    'wikidot': User.wikidot,
+    'displayname': User.display_name,
+    'tr_count': Leaderboard.translation_count,
+    'cr_count': Leaderboard.correction_count,
+    'points': Leaderboard.points,
+}, computed=('tr_role_html',))
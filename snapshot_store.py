@@ -0,0 +1,165 @@
+"""
+Content-addressed store for snapshots of original pages
+
+Page sources are saved as zstd compressed blobs named by the SHA-256 of their text, so a source
+that didn't change between revisions (or is shared by several pages) is only stored once.
+The PageSnapshot table maps each (wiki, slug, revision) to its blob.
+"""
+
+import difflib
+import hashlib
+import os
+import re
+import tempfile
+from logging import info, debug
+
+from pyzstd import compress, decompress
+
+from db import database, PageSnapshot
+
+# Snapshots saved as plain text files before the store existed are named <slug>-<revision>.txt
+r_legacy_snapshot = re.compile(r"^(.+)-(\d+)\.txt$")
+
+class SnapshotStore:
+    def __init__(self, root: str | os.PathLike | None = None):
+        # Resolved on first use, the working directory is only final once the app starts
+        self.__root = root
+
+    @property
+    def root(self) -> str:
+        return self.__root or os.path.join(os.getcwd(), 'temp', 'snapshots')
+
+    @property
+    def blob_dir(self) -> str:
+        return os.path.join(self.root, 'blobs')
+
+    def blob_path(self, digest: str) -> str:
+        # Split by the first two characters like git does, so no directory gets too big
+        return os.path.join(self.blob_dir, digest[:2], digest + '.zst')
+
+    def put(self, text: str) -> str:
+        """
+        Stores a text if it isn't stored yet and returns its hash
+        """
+        data = text.encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.blob_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Written under a temporary name so a reader never sees half a blob,
+            # a unique one because two workers might be saving the same text
+            blob = tempfile.NamedTemporaryFile(dir=os.path.dirname(path), suffix='.part', delete=False)
+            try:
+                with blob:
+                    blob.write(compress(data))
+                os.replace(blob.name, path)
+            finally:
+                if os.path.exists(blob.name):
+                    os.remove(blob.name)
+        return digest
+
+    @staticmethod
+    def read_blob(path: str | os.PathLike) -> str:
+        with open(path, 'rb') as blob:
+            return decompress(blob.read()).decode('utf-8')
+
+    def get(self, digest: str) -> str:
+        return self.read_blob(self.blob_path(digest))
+
+    def save(self, source_wiki: str, slug: str, revision: int, text: str) -> str:
+        """
+        Saves the source of a page revision and returns the path of its blob, saving a revision again replaces it
+        """
+        digest = self.put(text)
+        PageSnapshot.insert(source_wiki=source_wiki, slug=slug, revision=revision, blob=digest, size=len(text.encode('utf-8')))\
+            .on_conflict(conflict_target=[PageSnapshot.source_wiki, PageSnapshot.slug, PageSnapshot.revision],
+                         preserve=[PageSnapshot.blob, PageSnapshot.size, PageSnapshot.created]).execute()
+        return self.blob_path(digest)
+
+    @staticmethod
+    def find(source_wiki: str, slug: str, revision: int | None = None) -> PageSnapshot | None:
+        """
+        Manifest entry of a revision, the newest one if no revision is given
+        """
+        query = PageSnapshot.select().where((PageSnapshot.source_wiki == source_wiki) & (PageSnapshot.slug == slug))
+        if revision is not None:
+            return query.where(PageSnapshot.revision == revision).first()
+        return query.order_by(PageSnapshot.revision.desc()).first()
+
+    @staticmethod
+    def revisions(source_wiki: str, slug: str) -> list[PageSnapshot]:
+        return list(PageSnapshot.select().where((PageSnapshot.source_wiki == source_wiki) & (PageSnapshot.slug == slug))
+                    .order_by(PageSnapshot.revision))
+
+    @staticmethod
+    def latest(source_wiki: str) -> dict[str, PageSnapshot]:
+        """
+        Newest saved revision of every page of a wiki, read with a single query
+        """
+        query = PageSnapshot.select().where(PageSnapshot.source_wiki == source_wiki).order_by(PageSnapshot.revision)
+        # Later revisions overwrite earlier ones
+        return {snapshot.slug: snapshot for snapshot in query}
+
+    @staticmethod
+    def saved_slugs(source_wiki: str, revision: int) -> set[str]:
+        return {slug for (slug,) in PageSnapshot.select(PageSnapshot.slug)
+                .where((PageSnapshot.source_wiki == source_wiki) & (PageSnapshot.revision == revision)).tuples()}
+
+    def read(self, source_wiki: str, slug: str, revision: int | None = None) -> str | None:
+        snapshot = self.find(source_wiki, slug, revision)
+        return self.get(snapshot.blob) if snapshot else None
+
+    def diff(self, source_wiki: str, slug: str, old_revision: int, new_revision: int) -> str | None:
+        """
+        Unified diff between two saved revisions of a page, None if either of them isn't saved
+        """
+        old, new = self.find(source_wiki, slug, old_revision), self.find(source_wiki, slug, new_revision)
+        if not old or not new:
+            return None
+        # Same hash, same text
+        if old.blob == new.blob:
+            return ""
+        return "".join(difflib.unified_diff(self.get(old.blob).splitlines(keepends=True), self.get(new.blob).splitlines(keepends=True),
+                                            fromfile=f"{slug}-{old_revision}", tofile=f"{slug}-{new_revision}"))
+
+    def restore(self, source_wiki: str, slug: str, revision: int, directory: str | os.PathLike) -> str | None:
+        """
+        Writes a saved revision out as a plain text file the way snapshots used to be saved and returns its path
+        """
+        text = self.read(source_wiki, slug, revision)
+        if text is None:
+            return None
+        path = os.path.join(directory, f"{slug}-{revision}.txt")
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write(text)
+        return path
+
+    def count(self) -> int:
+        return PageSnapshot.select().count()
+
+    def import_legacy(self, delete: bool = False) -> int:
+        """
+        Copies plain text snapshots from the per-wiki directories into the store (and deletes them if delete is set),
+        returns how many were imported
+        """
+        imported = 0
+        for source_wiki in os.listdir(self.root):
+            wiki_dir = os.path.join(self.root, source_wiki)
+            if source_wiki == 'blobs' or not os.path.isdir(wiki_dir):
+                continue
+            # One transaction per wiki, committing after every file would be slow
+            with database.atomic():
+                for name in os.listdir(wiki_dir):
+                    if not (match := r_legacy_snapshot.match(name)):
+                        continue
+                    with open(os.path.join(wiki_dir, name), 'r', encoding='utf-8') as file:
+                        self.save(source_wiki, match.group(1), int(match.group(2)), file.read())
+                    imported += 1
+            if delete:
+                for name in filter(r_legacy_snapshot.match, os.listdir(wiki_dir)):
+                    os.remove(os.path.join(wiki_dir, name))
+            debug(f"Imported snapshots of {source_wiki}")
+        info(f"Imported {imported} snapshots into the store")
+        return imported
+
+snapshot_store = SnapshotStore()
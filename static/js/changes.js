@@ -48,8 +48,9 @@ function searchArticle(query) {
     $('#result-table-body').empty()
     fetch('/api/search/article?' + new URLSearchParams({
         'q': query,
-        'u': -1
-    })).then(response => response.json()).then(r => r.result.slice(0, 10).forEach(result => addTranslationRow(result)))
+        'u': -1,
+        'l': 10
+    })).then(response => response.json()).then(r => r.result.forEach(result => addTranslationRow(result)))
 }
 
 function handleSearch(e) {
@@ -2,6 +2,8 @@ from os.path import exists
 import os
 import itertools
 from json import load, dump, JSONDecodeError
+import json
+import base64
 from secrets import token_hex
 
 import logging
@@ -60,3 +62,30 @@ def count_files_rec(dir: str | os.PathLike) -> int:
     # itertools.chain gives us a generator again because this language is silly
     # empty it into a list again and return the length
     return len(list(flat_list))
+
+def encode_cursor(sort_key, row_id) -> str:
+    """
+    Packs a (sort key, row ID) pair into an opaque URL-safe token used for keyset pagination
+    """
+    # Datetimes aren't JSON serializable, SQLite stores them as text anyway
+    if not isinstance(sort_key, (int, float, str)) and sort_key is not None:
+        sort_key = str(sort_key)
+    payload = json.dumps([sort_key, row_id], separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(payload).decode('ascii').rstrip('=')
+
+def decode_cursor(token: str | None) -> tuple | None:
+    """
+    Unpacks a token created by encode_cursor, returns None if the token is missing or malformed
+    """
+    if not token:
+        return None
+    try:
+        # The padding is stripped when encoding to keep the URLs short
+        payload = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        sort_key, row_id = json.loads(payload)
+    except (ValueError, TypeError):
+        return None
+    # Anything else can't be compared with a column and makes SQLite fail
+    if not isinstance(row_id, int) or not isinstance(sort_key, (int, float, str)) and sort_key is not None:
+        return None
+    return sort_key, row_id
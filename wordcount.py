@@ -0,0 +1,178 @@
+"""
+Automatic word counts from Wikidot page sources
+
+The markup is skipped by a single regex pass over the source: blocks that never show up as text (CSS, code, HTML,
+comments) are dropped with their content, other tags like includes, divs and collapsibles are dropped without it
+and only the text of links is kept. Everything else that looks like a word is counted.
+Sources are counted in a process pool straight from the snapshot store, the parent only talks to the database.
+"""
+
+import re
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from logging import info, warning
+from urllib import parse
+
+from db import database, Article
+from snapshot_store import snapshot_store
+from imports import chunks, role_promotions
+import connectors.wikidotsite as wikidotsite
+
+import wikidot
+
+# Relative difference between the stored and counted word count that is still fine
+DEFAULT_TOLERANCE = 0.05
+# Sources downloaded at the same time with --fetch
+FETCH_WORKERS = 4
+# Sources handed to a worker process at once
+COUNT_CHUNK = 64
+
+r_markup = re.compile(r"""
+    (?P<comment>\[!--.*?--\])
+    # Blocks whose content is never shown as text
+  | (?P<block>\[\[(?P<block_tag>code|html|embed|math)\b.*?\[\[/(?P=block_tag)\]\])
+  | (?P<module>\[\[module\s+(?:css|listpages|listusers)\b.*?\[\[/module\]\])
+    # [[[page]]] or [[[page|text]]]
+  | \[\[\[(?P<page>[^\]|]*)(?:\|(?P<page_text>[^\]]*))?\]\]\]
+    # Any other tag, e.g. [[include ...]], [[div ...]], [[collapsible ...]], [[/div]], [[image ...]], [[footnote]]
+  | (?P<tag>\[\[.*?\]\])
+    # [https://example.com text] or [/page text]
+  | \[(?:https?://|/|\#|\*)\S*\s+(?P<link_text>[^\]]*)\]
+  | (?P<url>(?:https?|ftp)://\S+)
+  | (?P<entity>@<.*?>@)
+  | (?P<word>\w+(?:['’\-]\w+)*)
+""", re.IGNORECASE | re.DOTALL | re.VERBOSE)
+
+def count_words(source: str) -> int:
+    """
+    Number of words a reader sees on a page with this source
+    """
+    words = 0
+    for match in r_markup.finditer(source):
+        match match.lastgroup:
+            case 'word':
+                words += 1
+            case 'page' | 'page_text':
+                # Without a text the link shows the page name
+                words += count_words(match.group('page_text') or match.group('page'))
+            case 'link_text':
+                words += count_words(match.group('link_text'))
+    return words
+
+def count_blob(path: str) -> int:
+    # Runs in the worker processes, the blob is read there so only the path and the result are sent over
+    return count_words(snapshot_store.read_blob(path))
+
+def count_many(paths: list[str], workers: int | None = None) -> list[int]:
+    """
+    Counts the words of snapshot blobs in a process pool, results are in the same order as the paths
+    """
+    if workers == 1 or len(paths) < COUNT_CHUNK:
+        # Not worth starting the processes
+        return [count_blob(path) for path in paths]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(count_blob, paths, chunksize=COUNT_CHUNK))
+
+@dataclass
+class WordCount:
+    id: int
+    name: str
+    link: str
+    stored: int
+    counted: int
+
+    def differs(self, tolerance: float) -> bool:
+        return abs(self.counted - self.stored) > tolerance * self.stored
+
+@dataclass
+class WordCountResult:
+    counted: list[WordCount] = field(default_factory=list)
+    # (article name, reason) for each article that couldn't be counted
+    skipped: list = field(default_factory=list)
+
+    def mismatched(self, tolerance: float = DEFAULT_TOLERANCE) -> list[WordCount]:
+        return [c for c in self.counted if c.differs(tolerance)]
+
+def article_source_wiki(link: str, is_original: bool, wiki_map: dict[str, str]) -> str | None:
+    """
+    Wiki whose copy of the page is counted, translations are counted in the original
+    """
+    target_wiki = parse.urlparse(link).netloc.split('.')[0]
+    return target_wiki if is_original else wiki_map.get(target_wiki)
+
+def fetch_sources(missing: list[tuple[str, str]]) -> int:
+    """
+    Saves snapshots of pages that aren't in the snapshot store yet, returns how many were saved
+    """
+    # Same as the snapshot queue, the workers share one client
+    client = wikidot.Client()
+    def fetch(page: tuple[str, str]) -> bool:
+        link, source_wiki = page
+        try:
+            return wikidotsite.snapshot_original(link, source_wiki_name=source_wiki, client=client, fail_on_not_found=False) is not None
+        except Exception as e:
+            warning(f"Couldn't download the source of {link} ({str(e)})")
+            return False
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as pool:
+        return sum(pool.map(fetch, missing))
+
+def count_articles(workers: int | None = None, fetch: bool = False) -> WordCountResult:
+    """
+    Counts the words of every article with a link from the newest snapshot of its source
+
+    With fetch set, sources missing from the snapshot store are downloaded first
+    """
+    result = WordCountResult()
+    wiki_map = wikidotsite.map_target_wiki_to_source()
+    articles = list(Article.select(Article.id, Article.name, Article.link, Article.words, Article.is_original)
+                    .where(Article.link.is_null(False)).tuples())
+    pages = []
+    for id, name, link, words, is_original in articles:
+        if not (source_wiki := article_source_wiki(link, is_original, wiki_map)):
+            result.skipped.append((name, "No source wiki"))
+            continue
+        pages.append((id, name, link, words, source_wiki, wikidotsite.get_site_slug(link)))
+
+    # The manifest is read once per wiki instead of once per article
+    manifests = {wiki: snapshot_store.latest(wiki) for wiki in {page[4] for page in pages}}
+    if fetch:
+        missing = [(link, wiki) for _, _, link, _, wiki, slug in pages if slug not in manifests[wiki]]
+        if missing:
+            info(f"Downloaded {fetch_sources(missing)} of {len(missing)} missing sources")
+            manifests = {wiki: snapshot_store.latest(wiki) for wiki in manifests}
+
+    found = []
+    for page in pages:
+        id, name, link, words, source_wiki, slug = page
+        if (snapshot := manifests[source_wiki].get(slug)):
+            found.append((page, snapshot.blob))
+        else:
+            result.skipped.append((name, "Source not saved"))
+    # Articles with the same source are only counted once
+    blobs = list({blob for _, blob in found})
+    counts = dict(zip(blobs, count_many([snapshot_store.blob_path(blob) for blob in blobs], workers)))
+    for (id, name, link, words, _, _), blob in found:
+        result.counted.append(WordCount(id, name, link, words, counts[blob]))
+    info(f"Counted words of {len(result.counted)} articles ({len(blobs)} sources, {len(result.skipped)} skipped)")
+    return result
+
+def update_word_counts(counts: list[WordCount]) -> list:
+    """
+    Saves the counted word counts and returns the (user, new role) of each translator whose role changes
+    """
+    articles = {id: (author, is_original) for chunk in chunks([c.id for c in counts])
+                for id, author, is_original in Article.select(Article.id, Article.author, Article.is_original).where(Article.id.in_(chunk)).tuples()}
+    gains = {}
+    for count in counts:
+        author, is_original = articles[count.id]
+        # Originals only count for their bonus
+        if not is_original:
+            gains[author] = gains.get(author, 0) + (count.counted - count.stored)/1000
+    # Has to be done before the update, the triggers update the points right away
+    changes = role_promotions(gains)
+    for chunk in chunks(counts):
+        with database.atomic():
+            for count in chunk:
+                Article.update(words=count.counted).where(Article.id == count.id).execute()
+    info(f"Updated word counts of {len(counts)} articles")
+    return changes